@@ -0,0 +1,150 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import tempfile
+from timeit import default_timer as timer
+import numpy as np
+import tree_bootstrapped as tb
+from forest import Forest, bootstrap_weights
+from star_reader import KEPT_DATA, read_arrays
+from synthetic import synthetic_dataset, write_csv
+
+SIZES = [1000, 10000, 100000]
+JOBS = [1, 2]
+FOREST_SIZE = 10
+REPEAT = 3
+# Entries classified one by one in the single prediction case
+SINGLE_PREDICTIONS = 100
+
+
+def measure(func, repeat=REPEAT):
+    # Best and mean wall-clock time of a few runs of func
+    times = []
+    for i in range(repeat):
+        t_start = timer()
+        func()
+        times.append(timer() - t_start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def commit():
+    # Commit being measured, if this is a git checkout
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=SIZES, jobs=JOBS, forest_size=FOREST_SIZE, repeat=REPEAT, out=True):
+    results = []
+
+    def record(name, size, n_jobs, func, **extra):
+        result = dict(name=name, size=size, n_jobs=n_jobs, **measure(func, repeat))
+        result.update(extra)
+        results.append(result)
+        if out:
+            print("{:<16} {:>8} {:>3} jobs  best {:.4f}s  mean {:.4f}s"
+                  .format(name, size, n_jobs, result['best'], result['mean']))
+
+    for size in sizes:
+        dataset = synthetic_dataset(size, seed=size)
+        fields = dataset.fields
+        indices = np.arange(size)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'stars.csv')
+            write_csv(path, size, seed=size)
+            record('csv_load', size, 1, lambda: read_arrays(path, KEPT_DATA, cache=False))
+            read_arrays(path, KEPT_DATA)
+            record('csv_load_cached', size, 1, lambda: read_arrays(path, KEPT_DATA))
+
+        builder = tb.Builder(fields, dataset)
+        labels = builder.label_counts(indices)
+        root = builder.node(labels, 0)
+        gain, question, _ = builder.split(root, indices)
+
+        record('gini', size, 1, lambda: tb.gini(dataset, indices))
+        record('partition', size, 1, lambda: tb.partition(dataset, indices, question))
+        record('split', size, 1, lambda: builder.split(root, indices))
+
+        weights = bootstrap_weights(size, np.random.default_rng(0))
+        for n_jobs in jobs:
+            record('tree', size, n_jobs,
+                   lambda: tb.Tree(fields, dataset, out=False, n_jobs=n_jobs, weights=weights))
+            record('forest', size, n_jobs,
+                   lambda: Forest(fields, dataset, forest_size, out=False, n_jobs=n_jobs, seed=0))
+
+        forest = Forest(fields, dataset, forest_size, out=False, seed=0)
+        entries = [dataset[i] for i in range(min(size, SINGLE_PREDICTIONS))]
+
+        def oob():
+            forest.votes = None
+            forest.error_oob()
+
+        record('predict_single', size, 1, lambda: [forest.predict(entry) for entry in entries],
+               calls=len(entries))
+        record('predict_batch', size, 1, lambda: forest.predict_batch(dataset.features))
+        record('error_oob', size, 1, oob)
+
+    return {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': mp.cpu_count(),
+        'forest_size': forest_size,
+        'results': results,
+    }
+
+
+def smoke():
+    # Every case once, on a small dataset, just to see that they all run
+    run(sizes=[1000], jobs=[1], forest_size=2, repeat=1, out=False)
+
+
+def compare(old, new):
+    # Time of every case of new relative to the same case in old
+    key = lambda result: (result['name'], result['size'], result['n_jobs'])
+    before = {key(result): result for result in old['results']}
+
+    print("\n{:<16} {:>8} {:>4} {:>10} {:>10} {:>7}"
+          .format('case', 'size', 'jobs', 'before', 'after', 'ratio'))
+    for result in new['results']:
+        if key(result) not in before:
+            continue
+        old_best = before[key(result)]['best']
+        print("{:<16} {:>8} {:>4} {:>10.4f} {:>10.4f} {:>6.2f}x"
+              .format(result['name'], result['size'], result['n_jobs'], old_best,
+                      result['best'], result['best'] / old_best))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time training and prediction on synthetic stars")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--jobs', type=int, nargs='+', default=JOBS)
+    parser.add_argument('--trees', type=int, default=FOREST_SIZE)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help="earlier results to compare against")
+    parser.add_argument('--smoke', action='store_true',
+                        help="only check that every case runs, on a small dataset")
+    args = parser.parse_args()
+
+    if args.smoke:
+        smoke()
+        print("Every benchmark case ran")
+        parser.exit()
+
+    report = run(args.sizes, args.jobs, args.trees, args.repeat)
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print("\nResults written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
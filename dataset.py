@@ -0,0 +1,309 @@
+import json
+import os
+import numpy as np
+from question import is_numeric
+
+# Codes of a binned column: one for missing values, and the rest for
+# ranges of values
+BINS = 256
+MISSING_BIN = 0
+FIRST_BIN = 1
+# Rows read at a time when going over a whole column
+CHUNK_ROWS = 1 << 16
+# Rows the bin edges of a column are chosen from, at most
+SAMPLE_ROWS = 1 << 20
+# Files of a dataset saved as columns
+META_FILE = 'dataset.json'
+FEATURES_FILE = 'features.npy'
+LABELS_FILE = 'labels.npy'
+ORDER_FILE = 'order.npy'
+KNOWN_FILE = 'known.npy'
+
+
+class Entry(object):
+    # Single row of a dataset, shaped like the entries the trees classify
+    def __init__(self, label, data):
+        self.label = label
+        self.data = data
+
+
+def feature_matrix(entries, fields):
+    # Float matrix with the data of the entries, NaN where there's no value
+    features = np.empty((len(entries), len(fields)), dtype=np.float64)
+
+    for i, entry in enumerate(entries):
+        for j, value in enumerate(entry.data):
+            if value is None:
+                features[i, j] = np.nan
+            elif is_numeric(value):
+                features[i, j] = value
+            else:
+                raise ValueError("Non-numeric value {!r} for field {}"
+                                 .format(value, fields[j]))
+
+    return features
+
+
+def max_value(features, column):
+    # Highest value of a column, a chunk of rows at a time, or None if it
+    # has no values
+    highest = None
+    for start in range(0, features.shape[0], CHUNK_ROWS):
+        values = features[start:start + CHUNK_ROWS, column]
+        values = values[~np.isnan(values)]
+        if len(values) and (highest is None or values.max() > highest):
+            highest = values.max()
+    return highest
+
+
+class Bins(object):
+    # Features quantized into at most BINS codes per column
+    def __init__(self, codes, edges):
+        # One uint8 code per entry and column
+        self.codes = codes
+        # Upper edge of each value bin, per column, in increasing order
+        self.edges = edges
+
+    @classmethod
+    def from_features(cls, features, size=BINS, codes=None):
+        # The features are only read a chunk of rows at a time, and the
+        # codes are written into codes if given (e.g. a memory-mapped file)
+        size = min(size, BINS)
+        rows = features.shape[0]
+        if codes is None:
+            codes = np.empty(features.shape, dtype=np.uint8)
+        edges = []
+
+        # Edges are chosen from every row, or a sample of rows if there are
+        # too many to hold a column in memory
+        sample = slice(None)
+        if rows > SAMPLE_ROWS:
+            sample = np.sort(np.random.default_rng(0).choice(rows, SAMPLE_ROWS, replace=False))
+
+        for column in range(features.shape[1]):
+            values = features[sample, column]
+            values = values[~np.isnan(values)]
+
+            # Every distinct value gets its own bin while they fit, quantiles
+            # of the values are used as edges otherwise
+            column_edges = np.unique(values)
+            if len(column_edges) > size - FIRST_BIN:
+                quantiles = np.linspace(0, 1, size - FIRST_BIN + 1)[1:]
+                column_edges = np.unique(np.quantile(values, quantiles))
+
+            if rows > SAMPLE_ROWS:
+                # The last edge has to be the highest value of the column, not
+                # just of the sample, for every value to have a bin
+                highest = max_value(features, column)
+                if highest is not None and not len(column_edges):
+                    column_edges = np.array([highest])
+                elif highest is not None:
+                    column_edges[-1] = max(column_edges[-1], highest)
+
+            for start in range(0, rows, CHUNK_ROWS):
+                values = features[start:start + CHUNK_ROWS, column]
+                known = ~np.isnan(values)
+                chunk = np.full(len(values), MISSING_BIN, dtype=np.uint8)
+                # Values in (edges[k-1], edges[k]] go to value bin k
+                chunk[known] = FIRST_BIN + np.searchsorted(column_edges, values[known])
+                codes[start:start + CHUNK_ROWS, column] = chunk
+            edges.append(column_edges)
+
+        return cls(codes, edges)
+
+    def save(self, folder, size):
+        # Edges next to the codes in folder, written by from_features
+        np.savez(os.path.join(folder, 'bins{}.edges.npz'.format(size)), *self.edges)
+
+    @classmethod
+    def load(cls, folder, size):
+        codes = np.load(os.path.join(folder, 'bins{}.npy'.format(size)), mmap_mode='r')
+        with np.load(os.path.join(folder, 'bins{}.edges.npz'.format(size))) as edges:
+            return cls(codes, [edges['arr_{}'.format(k)] for k in range(codes.shape[1])])
+
+
+def write_columns(folder, fields, classes, chunks):
+    # Write a dataset to folder, from (features, labels) chunks of rows, so
+    # it can be opened memory-mapped with Dataset.open. The features are
+    # written column after column (Fortran order), so every column can be
+    # read on its own, and only a chunk of rows is ever in memory
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    columns = [os.path.join(folder, 'column{}.tmp'.format(k)) for k in range(len(fields))]
+    labels_path = os.path.join(folder, LABELS_FILE + '.tmp')
+
+    rows = 0
+    column_files = [open(path, 'wb') for path in columns]
+    try:
+        with open(labels_path, 'wb') as labels_file:
+            for features, labels in chunks:
+                features = np.asarray(features, dtype=np.float64)
+                for k, column_file in enumerate(column_files):
+                    column_file.write(np.ascontiguousarray(features[:, k]).tobytes())
+                labels_file.write(np.ascontiguousarray(labels, dtype=bool).tobytes())
+                rows += len(features)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+    with open(os.path.join(folder, FEATURES_FILE), 'wb') as features_file:
+        np.lib.format.write_array_header_1_0(features_file, {
+            'descr': np.dtype(np.float64).str, 'fortran_order': True,
+            'shape': (rows, len(fields))})
+        for path in columns:
+            with open(path, 'rb') as column_file:
+                while True:
+                    block = column_file.read(CHUNK_ROWS * 8)
+                    if not block:
+                        break
+                    features_file.write(block)
+            os.remove(path)
+
+    with open(os.path.join(folder, LABELS_FILE), 'wb') as labels_file:
+        np.lib.format.write_array_header_1_0(labels_file, {
+            'descr': np.dtype(bool).str, 'fortran_order': False,
+            'shape': (rows, len(classes))})
+        with open(labels_path, 'rb') as rows_file:
+            while True:
+                block = rows_file.read(CHUNK_ROWS * len(classes))
+                if not block:
+                    break
+                labels_file.write(block)
+    os.remove(labels_path)
+
+    with open(os.path.join(folder, META_FILE), 'w') as meta_file:
+        json.dump({'fields': list(fields), 'classes': list(classes)}, meta_file)
+
+
+def sort_columns(features, order):
+    # Fill order with the positions of the rows sorted by each column, from
+    # the highest value down, NaN last, and return how many aren't NaN
+    known = np.empty(features.shape[1], dtype=np.intp)
+    for column in range(features.shape[1]):
+        values = np.asarray(features[:, column])
+        order[:, column] = np.argsort(-values, kind='stable')
+        known[column] = np.count_nonzero(~np.isnan(values))
+    return known
+
+
+class Dataset(object):
+    def __init__(self, fields, features, labels, classes):
+        self.fields = fields
+        # One row per entry, one column per field, NaN where there's no value
+        self.features = np.asarray(features, dtype=np.float64)
+        # One row per entry, one column per class, True for each label
+        self.labels = np.asarray(labels, dtype=bool)
+        self.classes = list(classes)
+        # Binned features, by number of bins
+        self.bins = {}
+        # Folder the dataset is memory-mapped from, if it is
+        self.folder = None
+        # Entries sorted by each column and how many of them have a value,
+        # made by presorted the first time they're needed
+        self.order = None
+        self.known = None
+
+    @classmethod
+    def from_entries(cls, entries, fields):
+        classes = sorted(set(label for entry in entries for label in entry.label))
+        positions = {label: k for k, label in enumerate(classes)}
+
+        features = feature_matrix(entries, fields)
+        labels = np.zeros((len(entries), len(classes)), dtype=bool)
+
+        for i, entry in enumerate(entries):
+            for label in entry.label:
+                labels[i, positions[label]] = True
+
+        return cls(fields, features, labels, classes)
+
+    @classmethod
+    def open(cls, folder):
+        # Dataset written by write_columns (or save), memory-mapped, so the
+        # rows are only read from disk as they're needed
+        with open(os.path.join(folder, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+
+        features = np.load(os.path.join(folder, FEATURES_FILE), mmap_mode='r')
+        labels = np.load(os.path.join(folder, LABELS_FILE), mmap_mode='r')
+
+        dataset = cls(meta['fields'], features, labels, meta['classes'])
+        dataset.folder = folder
+        return dataset
+
+    def save(self, folder):
+        chunks = ((self.features[start:start + CHUNK_ROWS], self.labels[start:start + CHUNK_ROWS])
+                  for start in range(0, len(self), CHUNK_ROWS))
+        write_columns(folder, self.fields, self.classes, chunks)
+
+    def subset(self, indices):
+        # Dataset of some of the entries, copied into memory
+        return Dataset(self.fields, self.features[indices], self.labels[indices], self.classes)
+
+    def binned(self, size=BINS):
+        if size in self.bins:
+            return self.bins[size]
+
+        if self.folder is None:
+            self.bins[size] = Bins.from_features(self.features, size)
+            return self.bins[size]
+
+        # Memory-mapped datasets keep their codes in a file of their own,
+        # made once and shared by every process that opens the dataset
+        path = os.path.join(self.folder, 'bins{}.npy'.format(size))
+        if not os.path.exists(path):
+            tmp_path = os.path.join(self.folder, 'bins{}.tmp.npy'.format(size))
+            codes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                              shape=self.features.shape, fortran_order=True)
+            bins = Bins.from_features(self.features, size, codes)
+            codes.flush()
+            del codes
+            bins.save(self.folder, size)
+            os.replace(tmp_path, path)
+
+        self.bins[size] = Bins.load(self.folder, size)
+        return self.bins[size]
+
+    def presorted(self):
+        # Entries sorted by each column, from the highest value down (ties
+        # in the order of the entries) with the ones without a value last,
+        # one column of positions per column of features, and how many of
+        # them have a value. Made once for every tree trained on the dataset
+        if self.order is not None:
+            return self.order, self.known
+
+        if self.folder is None:
+            order = np.empty(self.features.shape, dtype=np.intp, order='F')
+            self.known = sort_columns(self.features, order)
+            self.order = order
+            return self.order, self.known
+
+        # Memory-mapped datasets keep them in files of their own, like the
+        # binned codes
+        path = os.path.join(self.folder, ORDER_FILE)
+        if not os.path.exists(path):
+            tmp_path = os.path.join(self.folder, 'order.tmp.npy')
+            order = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.intp,
+                                              shape=self.features.shape, fortran_order=True)
+            known = sort_columns(self.features, order)
+            order.flush()
+            del order
+            np.save(os.path.join(self.folder, KNOWN_FILE), known)
+            os.replace(tmp_path, path)
+
+        self.order = np.load(path, mmap_mode='r')
+        self.known = np.load(os.path.join(self.folder, KNOWN_FILE))
+        return self.order, self.known
+
+    def label(self, i):
+        return [self.classes[k] for k in np.flatnonzero(self.labels[i])]
+
+    def data(self, i):
+        return [None if np.isnan(value) else value
+                for value in self.features[i].tolist()]
+
+    def __getitem__(self, i):
+        return Entry(self.label(i), self.data(i))
+
+    def __len__(self):
+        return self.features.shape[0]
@@ -0,0 +1,210 @@
+import multiprocessing as mp
+import numpy as np
+import workers
+from dataset import Dataset, CHUNK_ROWS
+from forest import Forest
+from tree_bootstrapped import Tree
+
+# Folds of a cross-validation
+FOLDS = 5
+
+
+class Evaluation(object):
+    # Scores of a model over a test set, added up a chunk of rows at a time
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self.tested = 0
+        # Entries whose majority class is one of their labels
+        self.hits = 0
+        # Share of the votes that went to the labels of each entry, summed
+        self.success = 0.0
+        # The same, only for entries with more than one label
+        self.multi_tested = 0
+        self.multi_hits = 0
+        self.multi_success = 0.0
+        # One row per label, one column per majority class. Entries with
+        # several labels add a count to the row of each of them
+        self.confusion = np.zeros((len(classes), len(classes)), dtype=np.int64)
+
+    def add(self, votes, labels):
+        # Score a chunk of rows, from the votes of the model and their
+        # labels, both with one column per class of the model
+        predicted = votes.argmax(axis=1)
+        hits = labels[np.arange(len(labels)), predicted]
+        totals = votes.sum(axis=1)
+        success = (votes * labels).sum(axis=1) / np.where(totals > 0, totals, 1)
+        multi = labels.sum(axis=1) > 1
+
+        self.tested += len(labels)
+        self.hits += int(hits.sum())
+        self.success += float(success.sum())
+        self.multi_tested += int(multi.sum())
+        self.multi_hits += int(hits[multi].sum())
+        self.multi_success += float(success[multi].sum())
+
+        entries, classes = np.nonzero(labels)
+        np.add.at(self.confusion, (classes, predicted[entries]), 1)
+
+    def merge(self, other):
+        # Add the scores of another chunk, or fold
+        self.tested += other.tested
+        self.hits += other.hits
+        self.success += other.success
+        self.multi_tested += other.multi_tested
+        self.multi_hits += other.multi_hits
+        self.multi_success += other.multi_success
+        self.confusion += other.confusion
+
+    def accuracy(self):
+        return self.hits / float(self.tested) if self.tested else 0.0
+
+    def success_rate(self):
+        return self.success / self.tested if self.tested else 0.0
+
+    def multi_accuracy(self):
+        return self.multi_hits / float(self.multi_tested) if self.multi_tested else 0.0
+
+    def multi_success_rate(self):
+        return self.multi_success / self.multi_tested if self.multi_tested else 0.0
+
+    def summary(self):
+        accuracy = self.accuracy() * 100
+        lines = ["Tested {} entries.".format(self.tested),
+                 "Accuracy: {:.2f}%\nError: {:.2f}%".format(accuracy, 100 - accuracy),
+                 "Success (votes for the actual labels): {:.2f}%"
+                 .format(self.success_rate() * 100),
+                 "Multi-label entries: {}, accuracy {:.2f}%, success {:.2f}%"
+                 .format(self.multi_tested, self.multi_accuracy() * 100,
+                         self.multi_success_rate() * 100)]
+
+        width = max([len(str(label)) for label in self.classes] + [8])
+        lines.append("\nConfusion matrix (rows: labels, columns: majority class)")
+        lines.append(' ' * width + ''.join("{:>{}}".format(label, width + 1)
+                                           for label in self.classes))
+        for label, row in zip(self.classes, self.confusion):
+            lines.append("{:<{}}".format(label, width)
+                         + ''.join("{:>{}}".format(count, width + 1) for count in row))
+
+        return '\n'.join(lines)
+
+
+def flat_trees(model):
+    # Flat trees of a Forest, or of a single Tree
+    trees = model.trees if isinstance(model, Forest) else [model]
+    return [tree.flat for tree in trees]
+
+
+def class_columns(dataset, classes):
+    # Label column of the dataset for each class of a model, or -1 for the
+    # classes the dataset doesn't have. Labels the model doesn't know can
+    # never be predicted, so their column is left out
+    positions = {label: k for k, label in enumerate(dataset.classes)}
+    return np.array([positions.get(label, -1) for label in classes], dtype=np.intp)
+
+
+def score_chunk(flats, dataset, start, stop, classes, columns):
+    # Evaluation of the trees over rows start to stop of the dataset
+    features = dataset.features[start:stop]
+    votes = np.zeros((len(features), len(classes)))
+    for flat in flats:
+        votes += flat.predict(features)
+
+    labels = np.zeros((len(features), len(classes)), dtype=bool)
+    known = columns >= 0
+    labels[:, known] = dataset.labels[start:stop][:, columns[known]]
+
+    evaluation = Evaluation(classes)
+    evaluation.add(votes, labels)
+    return evaluation
+
+
+def evaluator(info):
+    # Pool task: score a chunk of the dataset the workers are attached to,
+    # with the trees they were given
+    start, stop, classes, columns = info
+    return score_chunk(workers.shared_trees(), workers.shared_dataset(), start, stop, classes,
+                       columns)
+
+
+def evaluate(model, dataset, n_jobs=None, chunk_rows=CHUNK_ROWS):
+    # Evaluation of a Tree or Forest over a test set, streamed through the
+    # flat trees a chunk of rows at a time. With more than one process, the
+    # chunks are scored in parallel, by workers attached to a shared copy of
+    # the test set
+    if not isinstance(dataset, Dataset):
+        dataset = Dataset.from_entries(dataset, model.fields)
+    if list(dataset.fields) != list(model.fields):
+        raise ValueError("Dataset fields {} don't match the model's {}"
+                         .format(dataset.fields, model.fields))
+
+    flats = flat_trees(model)
+    columns = class_columns(dataset, model.classes)
+    processes = n_jobs or mp.cpu_count()
+    # Enough chunks to keep every process busy
+    chunk_rows = max(min(chunk_rows, -(-len(dataset) // processes)), 1)
+    spans = [(start, min(start + chunk_rows, len(dataset)))
+             for start in range(0, len(dataset), chunk_rows)]
+
+    evaluation = Evaluation(model.classes)
+    if min(processes, len(spans)) < 2:
+        for start, stop in spans:
+            evaluation.merge(score_chunk(flats, dataset, start, stop, model.classes, columns))
+        return evaluation
+
+    tasks = [(start, stop, model.classes, columns) for start, stop in spans]
+    with workers.Pool(dataset, min(processes, len(spans)), flats) as pool:
+        for chunk in pool.imap(evaluator, tasks):
+            evaluation.merge(chunk)
+    return evaluation
+
+
+def train_fold(dataset, test, size, seed, options):
+    # Evaluation of a model trained on every entry but the ones in test,
+    # over those. A single Tree over all of its entries if size is None, a
+    # Forest of size trees otherwise
+    training = np.ones(len(dataset), dtype=bool)
+    training[test] = False
+    training_set = dataset.subset(training)
+
+    if size is None:
+        model = Tree(dataset.fields, training_set, np.arange(len(training_set)), out=False,
+                     n_jobs=1, seed=seed, **options)
+    else:
+        model = Forest(dataset.fields, training_set, size, out=False, n_jobs=1, seed=seed,
+                       **options)
+
+    return evaluate(model, dataset.subset(test), n_jobs=1)
+
+
+def fold_trainer(info):
+    # Pool task: train and evaluate one fold of the dataset the workers are
+    # attached to
+    test, size, seed, options = info
+    return train_fold(workers.shared_dataset(), test, size, seed, options)
+
+
+def cross_validate(fields, dataset, k=FOLDS, size=None, n_jobs=None, seed=None, **options):
+    # k-fold cross-validation: the entries are shuffled into k folds, and
+    # each fold is evaluated with a model trained on the other ones (see
+    # train_fold, which options are passed on to). The folds are trained in
+    # parallel, by workers attached to a single shared copy of the dataset.
+    # Returns the evaluation of every fold, and of all of them together
+    if not isinstance(dataset, Dataset):
+        dataset = Dataset.from_entries(dataset, fields)
+
+    order = np.random.default_rng(seed).permutation(len(dataset))
+    seeds = np.random.SeedSequence(seed).generate_state(k)
+    tasks = [(np.sort(test), size, int(fold_seed), options)
+             for test, fold_seed in zip(np.array_split(order, k), seeds)]
+
+    processes = min(n_jobs or mp.cpu_count(), k)
+    if processes < 2:
+        folds = [train_fold(dataset, *task) for task in tasks]
+    else:
+        with workers.Pool(dataset, processes) as pool:
+            folds = list(pool.imap(fold_trainer, tasks))
+
+    total = Evaluation(folds[0].classes)
+    for fold in folds:
+        total.merge(fold)
+    return folds, total
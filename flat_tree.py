@@ -0,0 +1,108 @@
+from collections import deque
+import numpy as np
+
+
+class FlatTree(object):
+    # A trained tree as parallel arrays, one position per node, so whole
+    # matrices of entries can be pushed down it at once
+    def __init__(self, feature, threshold, left, right, value, impurity, missing, legacy=False):
+        # Column each node asks about, -1 for the leaves
+        self.feature = feature
+        # Value the column must be greater than, NaN to ask for a missing value
+        self.threshold = threshold
+        # Positions of the matching (left) and non-matching (right) children
+        self.left = left
+        self.right = right
+        # Label counts of the leaves, one column per class
+        self.value = value
+        # Impurity of every node, by the criterion the tree was trained with
+        self.impurity = impurity
+        # Whether entries without a value go to the matching child
+        self.missing = missing
+        # Trees from version 1 model files were trained with zero never
+        # matching a numeric question, and keep predicting that way
+        self.legacy = legacy
+
+    @classmethod
+    def from_node(cls, root, classes):
+        positions = {label: k for k, label in enumerate(classes)}
+        nodes = []
+        pending = deque([root])
+
+        # Number the nodes in breadth-first order
+        while pending:
+            node = pending.popleft()
+            nodes.append(node)
+            if not node.is_leaf:
+                pending.append(node.left_branch)
+                pending.append(node.right_branch)
+
+        ids = {id(node): k for k, node in enumerate(nodes)}
+        size = len(nodes)
+
+        feature = np.full(size, -1, dtype=np.intp)
+        threshold = np.zeros(size, dtype=np.float64)
+        left = np.full(size, -1, dtype=np.intp)
+        right = np.full(size, -1, dtype=np.intp)
+        value = np.zeros((size, len(classes)), dtype=np.float64)
+        impurity = np.array([node.gini for node in nodes], dtype=np.float64)
+        missing = np.zeros(size, dtype=bool)
+
+        for k, node in enumerate(nodes):
+            if node.is_leaf:
+                for label, count in node.predictions.items():
+                    value[k, positions[label]] = count
+                continue
+
+            feature[k] = node.question.pos
+            if node.question.value is None:
+                threshold[k] = np.nan
+            else:
+                threshold[k] = node.question.value
+                missing[k] = node.question.missing
+            left[k] = ids[id(node.left_branch)]
+            right[k] = ids[id(node.right_branch)]
+
+        return cls(feature, threshold, left, right, value, impurity, missing)
+
+    def apply(self, features):
+        # Leaf reached by each row of the feature matrix
+        features = np.asarray(features, dtype=np.float64)
+        node = np.zeros(len(features), dtype=np.intp)
+        active = np.flatnonzero(self.feature[node] >= 0)
+
+        # Move every row still at an internal node down one level at a time
+        while len(active):
+            current = node[active]
+            values = features[active, self.feature[current]]
+            threshold = self.threshold[current]
+
+            # Same as Question.match, a NaN threshold asks for a missing value
+            without = np.isnan(values)
+            matching = np.where(np.isnan(threshold), without,
+                                np.where(without, self.missing[current], values > threshold))
+            if self.legacy:
+                matching &= np.isnan(threshold) | (values != 0)
+
+            node[active] = np.where(matching, self.left[current], self.right[current])
+            active = active[self.feature[node[active]] >= 0]
+
+        return node
+
+    def predict(self, features):
+        # Label counts of the leaf reached by each row
+        return self.value[self.apply(features)]
+
+    def arrays(self):
+        return {
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'left': self.left,
+            'right': self.right,
+            'value': self.value,
+            'impurity': self.impurity,
+            'missing': self.missing,
+        }
+
+    def __len__(self):
+        return len(self.feature)
@@ -1,60 +1,416 @@
-import random
-import operator
-from tree_bootstrapped import Tree
+from contextlib import closing
+import multiprocessing as mp
+from timeit import default_timer as timer
+import numpy as np
+import workers
+import model_file
+from tree_bootstrapped import Tree, split_pool
+from dataset import Dataset, feature_matrix, CHUNK_ROWS
+from metrics import Progress, Metrics
+
+
+def bootstrap_weights(n, rng):
+    # Times each of n entries is drawn into a bootstrap of n draws. The
+    # draws are made a chunk at a time, so they're never all in memory
+    weights = np.zeros(n, dtype=np.uint16)
+    for start in range(0, n, CHUNK_ROWS):
+        draws = rng.integers(n, size=min(CHUNK_ROWS, n - start))
+        weights += np.bincount(draws, minlength=n).astype(np.uint16)
+    return weights
+
+
+def vote_error(votes, labels):
+    # Share of the entries with any votes whose majority class isn't one of
+    # their labels, or nan if none has any yet (an empty forest, or one
+    # whose trees drew every entry into their bags)
+    voted = np.flatnonzero(votes.sum(axis=1) > 0)
+    if not len(voted):
+        return float('nan')
+    majority = votes[voted].argmax(axis=1)
+    successes = labels[voted, majority].sum()
+
+    return 1-(float(successes)/float(len(voted)))
+
+
+def out_of_bag_votes(flat, features, oob):
+    # Votes of a flat tree for its out-of-bag rows of a feature matrix, read
+    # a chunk of CHUNK_ROWS rows at a time so memory-mapped features are
+    # never loaded all at once. Yields (rows, votes) pairs
+    for start in range(0, len(oob), CHUNK_ROWS):
+        chunk = oob[start:start + CHUNK_ROWS]
+        yield chunk, flat.predict(features[chunk])
+
+
+def permuted_error(trees, dataset, votes, column, repeats, seed):
+    # Out-of-bag error with the values of a column shuffled among the
+    # out-of-bag entries of each tree, averaged over repeats shuffles.
+    # trees are (flat tree, out-of-bag entries) pairs, and votes their
+    # out-of-bag votes. Only trees that split on the column can vote any
+    # differently, so the others keep the votes they already have
+    rng = np.random.default_rng(seed)
+    permuted = np.repeat(votes[None], repeats, axis=0)
+
+    for flat, oob in trees:
+        if not len(oob) or not (flat.feature == column).any():
+            continue
+        values = np.asarray(dataset.features[oob, column])
+        shuffles = [rng.permutation(values) for repeat in range(repeats)]
+        # The rows are read a chunk at a time, as out_of_bag_votes does
+        for start in range(0, len(oob), CHUNK_ROWS):
+            chunk = oob[start:start + CHUNK_ROWS]
+            features = np.array(dataset.features[chunk])
+            unshuffled = flat.predict(features)
+            for repeat_votes, shuffled in zip(permuted, shuffles):
+                features[:, column] = shuffled[start:start + CHUNK_ROWS]
+                repeat_votes[chunk] += flat.predict(features) - unshuffled
+
+    return float(np.mean([vote_error(repeat_votes, dataset.labels)
+                          for repeat_votes in permuted]))
+
+
+def permuter(info):
+    # Pool task: permuted_error of a column, over the dataset and trees the
+    # workers were given
+    votes, column, repeats, seed = info
+    return permuted_error(workers.shared_trees(), workers.shared_dataset(), votes, column,
+                          repeats, seed)
+
+
+def tree_bytes(tree):
+    # Memory held by a trained tree: its flat arrays, and the bootstrap
+    # weights, out-of-bag entries and importances it keeps for the forest
+    arrays = list(tree.flat.arrays().values()) + [tree.counts, tree.oob, tree.importances]
+    return sum(array.nbytes for array in arrays if array is not None)
+
+
+def plant(info):
+    # Pool task: grow a tree over the dataset the workers are attached to,
+    # along with the Metrics recorded while growing it if asked for
+    seed, out, record, options = info
+    dataset = workers.shared_dataset()
+    rng = np.random.default_rng(seed)
+    weights = bootstrap_weights(len(dataset), rng)
+    metrics = Metrics(out) if record else None
+    tree = Tree(dataset.fields, dataset, None, out, n_jobs=1, seed=rng, metrics=metrics,
+                weights=weights, **options)
+    return tree, metrics
 
 
 class Forest(object):
-    def __init__(self, fields, dataset, size, tree_out=False, out=True):
+    def __init__(self, fields, dataset, size, tree_out=False, out=True, n_jobs=None, seed=None,
+                 metrics=None, **options):
+        # options are passed on to every Tree: bins, max_depth,
+        # min_samples_split, min_samples_leaf, min_impurity_decrease,
+        # max_leaf_nodes, max_features and random_thresholds. metrics, if
+        # given, is told about the training of every tree instead of
+        # printing it
+        if not isinstance(dataset, Dataset):
+            dataset = Dataset.from_entries(dataset, fields)
+
         self.fields = fields
         self.dataset = dataset
-        self.size = size
+        self.classes = dataset.classes
+        self.tree_out = tree_out
+        self.out = out
+        self.n_jobs = n_jobs
+        self.metrics = metrics
+        self.options = options
+        # Out-of-bag votes, gathered the first time they're needed and kept
+        # up to date as trees come and go
+        self.votes = None
 
+        # Each tree gets its own seed, for its bootstrap and its random
+        # choices, so the forest doesn't depend on which process ends up
+        # growing which tree. Tree k always gets the k-th seed spawned from
+        # the forest's sequence, however the forest got to k trees
+        self.seed = np.random.SeedSequence(seed)
+        self.seeds = []
         self.trees = []
-        for i in range(size):
-            n = len(dataset)
-            bootstrap = [random.randrange(n) for j in range(n)]
-            tree = Tree(self.fields, self.dataset, bootstrap, (tree_out and out))
-            self.trees.append(tree)
+        self.size = 0
 
-            if out:
-                print("\nPlanted tree {}".format(i))
+        self.grow(size)
 
-    def error_oob(self):
-        oob = []
-        for tree in self.trees:
-            oob.extend(tree.oob)
+    def grow(self, k, dataset=None):
+        # Plant k more trees. A forest loaded from a file needs the dataset
+        # it was trained with to grow, or to know its out-of-bag entries
+        if dataset is not None:
+            self.attach(dataset)
+
+        with closing(self.planting(k)) as trees:
+            for tree in trees:
+                pass
+
+    def grow_until(self, tolerance=0.001, window=5, max_size=None, max_time=None,
+                   max_memory=None, dataset=None):
+        # Plant trees until the out-of-bag error hasn't improved by more than
+        # tolerance over the last window trees, the forest has max_size
+        # trees, max_time seconds have passed or the trees take max_memory
+        # bytes (see tree_bytes; the dataset and the out-of-bag votes aren't
+        # counted). Returns the error curve, as (size, error) pairs
+        if dataset is not None:
+            self.attach(dataset)
+
+        curve = []
+        memory = sum(tree_bytes(tree) for tree in self.trees)
+        t_start = timer()
+
+        limit = None if max_size is None else max(max_size - self.size, 0)
+        with closing(self.planting(limit)) as trees:
+            for tree in trees:
+                curve.append((self.size, self.error_oob()))
+                memory += tree_bytes(tree)
+
+                errors = [error for size, error in curve]
+                if len(errors) > window and min(errors[:-window]) - min(errors[-window:]) <= tolerance:
+                    break
+                if max_time is not None and timer() - t_start >= max_time:
+                    break
+                if max_memory is not None and memory >= max_memory:
+                    break
+
+        return curve
 
-        oob = set(oob)
+    def planting(self, k=None):
+        # Plant up to k more trees (or for as long as asked, if k is None),
+        # yielding each one once it's part of the forest. The worker pool
+        # lives as long as the generator does
+        if self.dataset is None:
+            raise ValueError("A loaded forest needs its training dataset to grow")
+        if k == 0:
+            return
 
-        successes = 0
+        out = self.tree_out and self.out
+        report = self.metrics
+        if report is None and self.out:
+            report = Progress()
+        planted = 0
+        try:
+            if self.n_jobs is not None and self.n_jobs > 1:
+                # Grow whole trees in parallel, one per task, a pool-sized
+                # batch at a time. The bins or presorted columns are made
+                # first, so that the workers share them (in shared memory, or
+                # in files of their own for mapped datasets) instead of each
+                # making its own
+                if self.options.get('bins') is not None:
+                    self.dataset.binned(self.options['bins'])
+                elif self.options.get('random_thresholds') is None:
+                    self.dataset.presorted()
+                with workers.Pool(self.dataset, self.n_jobs) as pool:
+                    while k is None or planted < k:
+                        batch = self.n_jobs if k is None else min(self.n_jobs, k - planted)
+                        seeds = self.seed.spawn(batch)
+                        tasks = [(tree_seed, out, self.metrics is not None, self.options)
+                                 for tree_seed in seeds]
+                        for tree_seed, (tree, metrics) in zip(seeds, pool.imap(plant, tasks)):
+                            tree.dataset = self.dataset
+                            self.add_tree(tree_seed, tree)
+                            planted += 1
 
-        for i in oob:
-            entry = self.dataset[i]
-            votes = {}
+                            if metrics is not None:
+                                self.metrics.merge(metrics, self.size - 1)
+                            if report is not None:
+                                report.planted(self.size - 1)
+                            yield tree
+                return
 
+            # One split search pool for all of the trees, unless they're binned
+            pool = None
+            if self.options.get('bins') is None:
+                pool = split_pool(self.dataset, report, self.n_jobs)
+            try:
+                while k is None or planted < k:
+                    tree_seed = self.seed.spawn(1)[0]
+                    rng = np.random.default_rng(tree_seed)
+                    weights = bootstrap_weights(len(self.dataset), rng)
+                    if report is not None:
+                        report.start_tree(self.size)
+                    tree = Tree(self.fields, self.dataset, None, out, pool, n_jobs=1,
+                                seed=rng, metrics=self.metrics, weights=weights, **self.options)
+                    self.add_tree(tree_seed, tree)
+                    planted += 1
+
+                    if report is not None:
+                        report.planted(self.size - 1)
+                    yield tree
+            finally:
+                if pool is not None:
+                    pool.close()
+        finally:
+            # Seeds spawned for trees that never got planted are given back
+            self.rewind_seed()
+
+    def add_tree(self, seed, tree):
+        self.seeds.append(seed)
+        self.trees.append(tree)
+        self.size = len(self.trees)
+        if self.votes is not None:
+            self.add_oob_votes(tree)
+
+    def prune_to(self, k):
+        # Keep only the first k trees
+        for tree in self.trees[k:]:
+            if self.votes is not None:
+                for rows, votes in out_of_bag_votes(tree.flat, self.dataset.features, tree.oob):
+                    self.votes[rows] -= votes
+
+        del self.trees[k:]
+        del self.seeds[k:]
+        self.size = len(self.trees)
+        # Growing again plants the same trees that were pruned
+        self.rewind_seed()
+
+    def rewind_seed(self):
+        # Next seed spawned goes to the next tree planted
+        self.seed = np.random.SeedSequence(self.seed.entropy, n_children_spawned=self.size)
+
+    def attach(self, dataset):
+        # Give a loaded forest back its training dataset. The bootstrap of
+        # every tree is drawn again from its seed, to know what was out of
+        # its bag
+        if not isinstance(dataset, Dataset):
+            dataset = Dataset.from_entries(dataset, self.fields)
+        if list(dataset.classes) != list(self.classes):
+            raise ValueError("The dataset classes {} don't match the forest classes {}"
+                             .format(dataset.classes, self.classes))
+
+        self.dataset = dataset
+        self.votes = None
+        for seed, tree in zip(self.seeds, self.trees):
+            tree.dataset = dataset
+            if seed is None:
+                # Unknown bootstrap, the tree never votes out of bag
+                tree.oob = np.empty(0, dtype=np.intp)
+                continue
+            tree.counts = bootstrap_weights(len(dataset), np.random.default_rng(seed))
+            tree.oob = np.flatnonzero(tree.counts == 0)
+
+    def add_oob_votes(self, tree):
+        # Add the votes of a tree for the entries that were out of its bag
+        for rows, votes in out_of_bag_votes(tree.flat, self.dataset.features, tree.oob):
+            self.votes[rows] += votes
+
+    def oob_votes(self):
+        # One row per entry and one column per class, with the votes of the
+        # trees each entry was out of bag for
+        if self.votes is None:
+            self.votes = np.zeros((len(self.dataset), len(self.dataset.classes)))
             for tree in self.trees:
-                if i not in tree.indices:
-                    predict = tree.classify(entry).predictions
-                    for key, value in predict.items():
-                        if key not in votes:
-                            votes[key] = predict[key]
-                        else:
-                            votes[key] += predict[key]
+                self.add_oob_votes(tree)
+
+        return self.votes
+
+    def oob_predict(self):
+        # Class position voted by the majority for each entry, or -1 for
+        # the entries that were never out of bag
+        votes = self.oob_votes()
+        majority = votes.argmax(axis=1)
+        majority[votes.sum(axis=1) == 0] = -1
+        return majority
 
-            majority = max(votes.items(), key=operator.itemgetter(1))[0]
-            if majority in entry.label:
-                successes += 1
+    def error_oob(self):
+        return vote_error(self.oob_votes(), self.dataset.labels)
+
+    def feature_importances(self):
+        # Mean decrease in impurity of each field: the impurity decrease of
+        # every split on it, weighted by the share of the entries in the node
+        # split, added up by tree, made to add up to one in each tree and
+        # averaged over the trees
+        importances = [tree.importances for tree in self.trees if tree.importances is not None]
+        if not importances:
+            raise ValueError("The trees have no importances, they were saved without them")
+
+        importances = np.array(importances)
+        totals = importances.sum(axis=1)[:, None]
+        return (importances / np.where(totals > 0, totals, 1)).mean(axis=0)
+
+    def permutation_importances(self, repeats=5, n_jobs=None, seed=None):
+        # How much the out-of-bag error of each field grows when its values
+        # are shuffled among the out-of-bag entries of every tree, averaged
+        # over repeats shuffles. The fields are shuffled in parallel, on
+        # workers attached to a shared copy of the dataset
+        if self.dataset is None:
+            raise ValueError("A loaded forest needs its training dataset for its out-of-bag error")
 
-        return 1-(float(successes)/float(len(oob)))
+        votes = self.oob_votes()
+        error = vote_error(votes, self.dataset.labels)
+        trees = [(tree.flat, tree.oob) for tree in self.trees]
+        seeds = np.random.SeedSequence(seed).spawn(len(self.fields))
+
+        processes = min(n_jobs or mp.cpu_count(), len(self.fields))
+        if processes < 2:
+            errors = [permuted_error(trees, self.dataset, votes, column, repeats, column_seed)
+                      for column, column_seed in enumerate(seeds)]
+        else:
+            tasks = [(votes, column, repeats, column_seed)
+                     for column, column_seed in enumerate(seeds)]
+            with workers.Pool(self.dataset, processes, trees) as pool:
+                errors = pool.map(permuter, tasks)
+
+        return np.array(errors) - error
 
     def predict(self, entry):
-        votes = {}
+        majority = self.predict_batch(feature_matrix([entry], self.fields))[0]
+        return self.classes[majority]
+
+    def vote_batch(self, features):
+        # Summed leaf label counts of every tree for each row of a feature
+        # matrix, one column per class in self.classes
+        votes = np.zeros((len(features), len(self.classes)))
         for tree in self.trees:
-            predict = tree.classify(entry).predictions
-            for key, value in predict.items():
-                if key not in votes:
-                    votes[key] = predict[key]
-                else:
-                    votes[key] += predict[key]
-        majority = max(votes.items(), key=operator.itemgetter(1))[0]
-        return majority
+            votes += tree.flat.predict(features)
+        return votes
+
+    def predict_batch(self, features):
+        # Position in self.classes of the majority class of each row
+        return self.vote_batch(features).argmax(axis=1)
+
+    def save(self, path):
+        # Only the flat trees are saved, not the data they were trained
+        # with. The seeds and options are, so a loaded forest can go on
+        # growing just like the original would have
+        settings = {
+            'entropy': str(self.seed.entropy),
+            'options': self.options,
+            # Trees that were loaded without their seeds, and still have none
+            'unseeded': [k for k, seed in enumerate(self.seeds) if seed is None],
+        }
+        extra = None
+        if self.trees and all(tree.importances is not None for tree in self.trees):
+            extra = {'importances': np.array([tree.importances for tree in self.trees])}
+        model_file.save(path, self.fields, self.classes, [tree.flat for tree in self.trees],
+                        extra, settings)
+
+    @classmethod
+    def load(cls, path):
+        fields, classes, flats, extra, settings = model_file.load(path)
+
+        forest = cls.__new__(cls)
+        forest.fields = fields
+        forest.dataset = None
+        forest.classes = classes
+        forest.tree_out = False
+        forest.out = False
+        forest.n_jobs = None
+        forest.metrics = None
+        forest.options = settings.get('options', {})
+        forest.votes = None
+        forest.trees = [Tree.from_flat(fields, classes, flat) for flat in flats]
+        if 'importances' in extra:
+            for tree, importances in zip(forest.trees, extra['importances']):
+                tree.importances = importances
+        forest.size = len(forest.trees)
+
+        if 'entropy' in settings:
+            forest.seed = np.random.SeedSequence(int(settings['entropy']))
+            forest.seeds = forest.seed.spawn(forest.size)
+            for k in settings.get('unseeded', []):
+                forest.seeds[k] = None
+        else:
+            # Saved without its seeds, so it can only grow from new ones.
+            # Tree k still gets the k-th seed spawned, the ones of the
+            # loaded trees going unused, so saving and loading it again
+            # gives every tree its seed back
+            forest.seed = np.random.SeedSequence()
+            forest.seeds = [None] * len(forest.trees)
+            forest.rewind_seed()
+        return forest
@@ -1,9 +1,10 @@
 import os
-import random
 from timeit import default_timer as timer
-from star_reader import read_stars
+import numpy as np
+from star_reader import read_dataset
 from tree_bootstrapped import Tree
 from forest import Forest
+from evaluation import evaluate, cross_validate, FOLDS
 
 
 OUTPUT_FOLDER = "output/forest"
@@ -24,15 +25,19 @@ if __name__ == '__main__':
     else:
         output = open(OUTPUT_FOLDER + "/testing.txt", 'a', encoding="utf-8")
 
-    dataset, fields = read_stars()
+    dataset, names = read_dataset()
+    fields = dataset.fields
 
-    random.shuffle(dataset)
+    order = np.random.default_rng().permutation(len(dataset))
 
     cutoff = 0.25
-    forest_size = 10
+    # The forest grows until its out-of-bag error stops improving
+    max_forest_size = 100
+    # Trees of the forests trained for the cross-validation
+    cv_forest_size = 10
 
     split = int(len(dataset) * cutoff)
-    training, testing = dataset[:split], dataset[split + 1:]
+    training_set, testing_set = dataset.subset(order[:split]), dataset.subset(order[split + 1:])
 
     log("\n----------\n", output)
 
@@ -42,29 +47,17 @@ if __name__ == '__main__':
     t_start = timer()
 
     log("Dataset split: Training with {}% of the set".format(cutoff*100), output)
-    log("Training set: {} entries.".format(len(training)), output)
-    log("Testing set: {} entries.".format(len(testing)), output)
+    log("Training set: {} entries.".format(len(training_set)), output)
+    log("Testing set: {} entries.".format(len(testing_set)), output)
 
-    tree = Tree(fields, training, [i for i in range(len(training))])
+    tree = Tree(fields, training_set, [i for i in range(len(training_set))])
 
     t_end = timer()
     log("Training complete.\nElapsed time: {:.3f}\n".format(t_end - t_start), output)
 
     log("\n-- TREE TEST --\n", output)
 
-    total_success = 0
-
-    for entry in testing:
-        success, predict = tree.predict(entry)
-        # print("Actual: {}\tPredicted: {}.\tSuccess: {}".format(entry.label, predict, success))
-        total_success += success
-
-    tested = len(testing)
-    s_rate = float(total_success)*100/float(tested)
-
-    log("\nTested {} entries.".format(tested), output)
-
-    log("Accuracy: {:.2f}%\nError: {:.2f}%".format(s_rate, 100-s_rate), output)
+    log(evaluate(tree, testing_set).summary(), output)
 
     log("\n-- FOREST TRAINING --\n", output)
 
@@ -72,34 +65,45 @@ if __name__ == '__main__':
     t_start = timer()
 
     log("Dataset split: Training with {}% of the set".format(cutoff*100), output)
-    log("Training set: {} entries.".format(len(training)), output)
-    log("Testing set: {} entries.".format(len(testing)), output)
+    log("Training set: {} entries.".format(len(training_set)), output)
+    log("Testing set: {} entries.".format(len(testing_set)), output)
 
-    forest = Forest(fields, training, forest_size)
+    forest = Forest(fields, training_set, 0)
+    curve = forest.grow_until(max_size=max_forest_size)
 
     t_end = timer()
     log("Training complete.\nElapsed time: {:.3f}\n".format(t_end - t_start), output)
 
+    log("Out-of-bag error by forest size:", output)
+    for size, error in curve:
+        log("{:4d} trees: {:.2f}%".format(size, error*100), output)
+
     log("\n-- FOREST TEST --\n", output)
 
-    total_success = 0
+    log(evaluate(forest, testing_set).summary(), output)
+
+    error = forest.error_oob()
 
-    for entry in testing:
-        label = entry.label
-        majority = forest.predict(entry)
-        if majority in label:
-            # print("Actual: {}\tPredicted: {}".format(label, predict))
-            total_success += 1
+    log("\nError Out-of-Bag: {:.2f}%".format(error*100), output)
 
-    tested = len(testing)
-    s_rate = float(total_success)*100/float(tested)
+    log("\n-- FEATURE IMPORTANCE --\n", output)
 
-    log("\nTested {} entries.".format(tested), output)
+    gains = forest.feature_importances()
+    permuted = forest.permutation_importances()
+    log("{:<8} {:>12} {:>16}".format('field', 'impurity', 'OOB error rise'), output)
+    for field, gain, rise in zip(fields, gains, permuted):
+        log("{:<8} {:>11.2f}% {:>15.2f}%".format(field, gain*100, rise*100), output)
 
-    log("Accuracy: {:.2f}%\nError: {:.2f}%".format(s_rate, 100-s_rate), output)
+    log("\n-- CROSS-VALIDATION --\n", output)
 
-    error = forest.error_oob()
+    log("{} folds of the whole set, forests of {} trees".format(FOLDS, cv_forest_size), output)
+    t_start = timer()
 
-    log("\nError Out-of-Bag: {:.2f}%".format(error*100), output)
+    folds, total = cross_validate(fields, dataset, FOLDS, cv_forest_size)
+
+    for k, fold in enumerate(folds):
+        log("Fold {}: accuracy {:.2f}%".format(k, fold.accuracy()*100), output)
+    log("Elapsed time: {:.3f}\n".format(timer() - t_start), output)
+    log(total.summary(), output)
 
     output.close()
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Impurity kernels. They take label counts over the last axis and what
+# those add up to (see label_mass), and batch over any leading axes, so
+# every candidate split of a column is scored with a single call
+
+
+def gini(counts, totals):
+    prob = counts / np.asarray(totals, dtype=np.float64)[..., None]
+
+    return 1 - (prob**2).sum(axis=-1)
+
+
+def entropy(counts, totals):
+    prob = counts / np.asarray(totals, dtype=np.float64)[..., None]
+
+    # Classes a node doesn't have add nothing, instead of 0 * log(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(prob > 0, prob * np.log2(prob), 0)
+    return -terms.sum(axis=-1)
+
+
+def label_mass(counts):
+    # What label counts add up to, the total the kernels share them out of.
+    # It's the size of the node with 'fractional' credit, but more than it
+    # with 'full' credit if the node has multi-label entries. Nodes without
+    # any label count as 1, to leave their probabilities at 0
+    mass = np.asarray(counts, dtype=np.float64).sum(axis=-1)
+    return np.where(mass > 0, mass, 1)
+
+
+CRITERIA = {'gini': gini, 'entropy': entropy}
+
+
+def criterion(name):
+    # Kernel for a criterion name
+    if name not in CRITERIA:
+        raise ValueError("Unknown criterion {!r}".format(name))
+    return CRITERIA[name]
+
+
+def label_shares(labels, multi_label='full'):
+    # What each label of each entry (row of a label matrix) counts for.
+    # With 'full' credit, every label counts as a whole entry, so an entry
+    # with k labels adds k to the label counts of a node, and None is
+    # returned. With 'fractional' credit, each label counts 1/k, so the
+    # label counts of a node always add up to its size
+    if multi_label == 'full':
+        return None
+    if multi_label == 'fractional':
+        labels_per_entry = labels.sum(axis=1)
+        return 1.0 / np.maximum(labels_per_entry, 1)
+    raise ValueError("Unknown multi_label {!r}".format(multi_label))
+
+
+def weighted_labels(labels, multi_label='full'):
+    # Label matrix with each label weighted by its share
+    shares = label_shares(labels, multi_label)
+    if shares is None:
+        return labels
+    return labels * shares[:, None]
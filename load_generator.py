@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import json
+from timeit import default_timer as timer
+import numpy as np
+from server import HOST, PORT
+from star_reader import KEPT_DATA
+from synthetic import star_arrays
+
+CLIENTS = 32
+REQUESTS = 200
+# Requests each client has on the wire at once
+PIPELINE = 1
+
+
+async def client(host, port, rows, pipeline, latencies):
+    # Send the rows as prediction requests, by field name so the model may
+    # use any of KEPT_DATA, keeping up to pipeline of them waiting for an
+    # answer at a time
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = []
+
+    async def receive():
+        line = await reader.readline()
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        latencies.append(timer() - sent.pop(0))
+
+    for row in rows:
+        values = {field: value for field, value in zip(KEPT_DATA, row) if value == value}
+        writer.write(json.dumps({'values': values}).encode('utf-8') + b'\n')
+        sent.append(timer())
+        if len(sent) >= pipeline:
+            await writer.drain()
+            await receive()
+
+    await writer.drain()
+    while sent:
+        await receive()
+
+    writer.close()
+
+
+async def server_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"stats": true}\n')
+    stats = json.loads(await reader.readline())
+    writer.close()
+    return stats
+
+
+async def run(host=HOST, port=PORT, clients=CLIENTS, requests=REQUESTS, pipeline=PIPELINE):
+    features, labels = star_arrays(clients * requests, seed=0)
+    latencies = []
+
+    t_start = timer()
+    await asyncio.gather(*[client(host, port, features[k::clients].tolist(), pipeline, latencies)
+                           for k in range(clients)])
+    elapsed = timer() - t_start
+
+    latencies = np.array(latencies) * 1000
+    print("{} requests from {} clients in {:.3f}s: {:.0f} requests/s"
+          .format(len(latencies), clients, elapsed, len(latencies) / elapsed))
+    print("Latency (ms): p50 {:.2f}  p95 {:.2f}  p99 {:.2f}  max {:.2f}"
+          .format(*np.percentile(latencies, [50, 95, 99, 100])))
+
+    stats = await server_stats(host, port)
+    print("Server: {} requests in {} batches, {:.1f} per batch"
+          .format(stats['requests'], stats['batches'], stats['mean_batch']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test a running prediction server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--clients', type=int, default=CLIENTS)
+    parser.add_argument('--requests', type=int, default=REQUESTS, help="requests per client")
+    parser.add_argument('--pipeline', type=int, default=PIPELINE)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.host, args.port, args.clients, args.requests, args.pipeline))
@@ -0,0 +1,157 @@
+import json
+from collections import defaultdict
+
+
+class Progress(object):
+    # Prints how the training goes. Trees and forests call these hooks on
+    # whatever object they're given, and skip them (and the timers behind
+    # them) altogether when they're given None
+    def start_tree(self, index):
+        pass
+
+    def pool(self, processes, crossover):
+        print("-- Split search pool: {} CPUs for nodes of {} or more entries\n"
+              .format(processes, crossover))
+
+    def dispatch(self, processes, tasks, start, seconds, busy):
+        print("\n-- Used {} CPUs to parallelize the split search\n".format(processes))
+
+    def split(self, level, size, gain, candidates, start, seconds):
+        print("Split search over {} entries.".format(size))
+
+    def partition(self, level, question, left, right, start, seconds):
+        print("Found a level {} split:".format(level))
+        print(question)
+        print("Matching: {} entries\tNon-matching: {} entries".format(left, right))
+
+    def leaf(self, level, size):
+        print("Found a leaf at level {}".format(level))
+
+    def tree(self, nodes, leaves, start, seconds):
+        pass
+
+    def planted(self, index):
+        print("\nPlanted tree {}".format(index))
+
+
+class Metrics(Progress):
+    # Records every hook call as an event, with its start time and duration
+    # where it has them, to be summed up as a table or written as a trace
+    # file. Only prints as well if out is set
+    def __init__(self, out=False):
+        self.out = out
+        self.events = []
+        # Tree the events are being recorded for
+        self.index = None
+
+    def record(self, name, start=None, seconds=None, **args):
+        self.events.append(dict(name=name, tree=self.index, start=start, seconds=seconds, **args))
+
+    def start_tree(self, index):
+        self.index = index
+
+    def pool(self, processes, crossover):
+        self.record('pool', processes=processes, crossover=crossover)
+        if self.out:
+            Progress.pool(self, processes, crossover)
+
+    def dispatch(self, processes, tasks, start, seconds, busy):
+        # busy is the time the workers spent on the tasks, so what the
+        # dispatch takes on top of seconds - busy / processes is overhead
+        self.record('dispatch', start, seconds, processes=processes, tasks=tasks, busy=busy)
+        if self.out:
+            Progress.dispatch(self, processes, tasks, start, seconds, busy)
+
+    def split(self, level, size, gain, candidates, start, seconds):
+        self.record('split', start, seconds, level=level, size=size, gain=gain,
+                    candidates=candidates)
+        if self.out:
+            Progress.split(self, level, size, gain, candidates, start, seconds)
+
+    def partition(self, level, question, left, right, start, seconds):
+        self.record('partition', start, seconds, level=level, left=left, right=right)
+        if self.out:
+            Progress.partition(self, level, question, left, right, start, seconds)
+
+    def leaf(self, level, size):
+        self.record('leaf', level=level, size=size)
+        if self.out:
+            Progress.leaf(self, level, size)
+
+    def tree(self, nodes, leaves, start, seconds):
+        self.record('tree', start, seconds, nodes=nodes, leaves=leaves)
+
+    def planted(self, index):
+        if self.out:
+            Progress.planted(self, index)
+
+    def merge(self, other, index=None):
+        # Add the events recorded by another Metrics, in a worker process
+        for event in other.events:
+            event = dict(event)
+            if index is not None:
+                event['tree'] = index
+            self.events.append(event)
+
+    def summary(self):
+        # Count and time of every kind of event, and the split search by
+        # tree level, as a table
+        lines = ["{:<10} {:>8} {:>12} {:>12}".format('event', 'count', 'total (s)', 'mean (ms)')]
+        by_name = defaultdict(list)
+        for event in self.events:
+            by_name[event['name']].append(event)
+
+        for name, events in by_name.items():
+            seconds = [event['seconds'] for event in events if event['seconds'] is not None]
+            if seconds:
+                lines.append("{:<10} {:>8} {:>12.4f} {:>12.4f}"
+                             .format(name, len(events), sum(seconds),
+                                     sum(seconds) * 1000 / len(seconds)))
+            else:
+                lines.append("{:<10} {:>8}".format(name, len(events)))
+
+        dispatches = by_name.get('dispatch', [])
+        if dispatches:
+            overhead = sum(event['seconds'] - event['busy'] / event['processes']
+                           for event in dispatches)
+            lines.append("\nPool dispatch overhead: {:.4f}s over {} dispatches"
+                         .format(overhead, len(dispatches)))
+
+        levels = defaultdict(lambda: [0, 0, 0, 0.0])
+        for event in by_name.get('split', []):
+            level = levels[event['level']]
+            level[0] += 1
+            level[1] += event['size']
+            level[2] += event['candidates']
+            level[3] += event['seconds']
+
+        if levels:
+            lines.append("\n{:<6} {:>8} {:>12} {:>12} {:>12}"
+                         .format('level', 'nodes', 'entries', 'candidates', 'total (s)'))
+            for level in sorted(levels):
+                lines.append("{:<6} {:>8} {:>12} {:>12} {:>12.4f}".format(level, *levels[level]))
+
+        return '\n'.join(lines)
+
+    def trace(self):
+        # Events in the Trace Event Format, which chrome://tracing and
+        # Perfetto open: one row per tree, one bar per timed event
+        timed = [event for event in self.events if event['start'] is not None]
+        origin = min([event['start'] for event in timed] or [0])
+
+        trace_events = []
+        for event in timed:
+            args = {key: value for key, value in event.items()
+                    if key not in ('name', 'tree', 'start', 'seconds')}
+            trace_events.append({
+                'name': event['name'], 'ph': 'X', 'pid': 0,
+                'tid': event['tree'] if event['tree'] is not None else 0,
+                'ts': (event['start'] - origin) * 1e6, 'dur': event['seconds'] * 1e6,
+                'args': args,
+            })
+        return {'traceEvents': trace_events}
+
+    def write_trace(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.trace(), trace_file)
+
@@ -0,0 +1,132 @@
+import json
+import mmap
+import struct
+import numpy as np
+from flat_tree import FlatTree
+
+# File layout: MAGIC, then the format version and the length of the JSON
+# header as little-endian uint32, then the header itself, and then every
+# array, each one starting at a multiple of ALIGN. The header has the
+# fields, the classes, the number of trees, which of them are legacy
+# trees from version 1 files, any settings of the model,
+# and the name, dtype, shape and offset of every array
+MAGIC = b'RFMODEL\0'
+VERSION = 2
+PREFIX = struct.Struct('<8sII')
+ALIGN = 8
+
+FLAT_ARRAYS = ['feature', 'threshold', 'left', 'right', 'value', 'impurity', 'missing']
+# Every array is stored with a fixed dtype, whatever the platform
+DTYPES = {
+    'feature': '<i8',
+    'threshold': '<f8',
+    'left': '<i8',
+    'right': '<i8',
+    'value': '<f8',
+    'impurity': '<f8',
+    'missing': '|b1',
+}
+
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save(path, fields, classes, flats, extra=None, settings=None):
+    # Write the flat trees, plus any extra named arrays, to a model file.
+    # settings is anything else worth keeping that JSON can hold
+    arrays = []
+    for i, flat in enumerate(flats):
+        for name, array in flat.arrays().items():
+            arrays.append(('tree{}/{}'.format(i, name), array.astype(DTYPES[name])))
+    for name, array in (extra or {}).items():
+        arrays.append((name, np.ascontiguousarray(array)))
+
+    # The offsets depend on the length of the header, which depends on the
+    # offsets, so they're measured from the end of the header
+    table = []
+    offset = 0
+    for name, array in arrays:
+        offset = aligned(offset)
+        table.append({'name': name, 'dtype': array.dtype.str,
+                      'shape': list(array.shape), 'offset': offset})
+        offset += array.nbytes
+
+    header = json.dumps({'fields': list(fields), 'classes': list(classes),
+                         'trees': len(flats), 'settings': settings or {},
+                         'legacy_trees': [i for i, flat in enumerate(flats) if flat.legacy],
+                         'arrays': table}).encode('utf-8')
+    start = aligned(PREFIX.size + len(header))
+
+    with open(path, 'wb') as model_file:
+        model_file.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+        model_file.write(header)
+        for (name, array), entry in zip(arrays, table):
+            model_file.write(b'\0' * (start + entry['offset'] - model_file.tell()))
+            model_file.write(array.tobytes())
+
+
+def read_arrays(buffer, header, start):
+    arrays = {}
+    for entry in header['arrays']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        if count:
+            array = np.frombuffer(buffer, dtype=dtype, count=count, offset=start + entry['offset'])
+        else:
+            array = np.empty(0, dtype=dtype)
+        arrays[entry['name']] = array.reshape(entry['shape'])
+    return arrays
+
+
+def read_v1(buffer, header, start):
+    # Version 1 trees had no missing value directions: entries without a
+    # value always went to the non-matching side. Zero never matched a
+    # numeric question either, which the trees keep as legacy
+    arrays = read_arrays(buffer, header, start)
+
+    flats = []
+    for i in range(header['trees']):
+        tree = [arrays.pop('tree{}/{}'.format(i, name)) for name in FLAT_ARRAYS[:-1]]
+        flats.append(FlatTree(*tree, np.zeros(len(tree[0]), dtype=bool), legacy=True))
+
+    return header['fields'], header['classes'], flats, arrays, {}
+
+
+def read_v2(buffer, header, start):
+    arrays = read_arrays(buffer, header, start)
+
+    legacy = set(header.get('legacy_trees', []))
+    flats = []
+    for i in range(header['trees']):
+        flats.append(FlatTree(*[arrays.pop('tree{}/{}'.format(i, name)) for name in FLAT_ARRAYS],
+                              legacy=i in legacy))
+
+    return header['fields'], header['classes'], flats, arrays, header.get('settings', {})
+
+
+# Reader for every format version that can still be loaded
+READERS = {
+    1: read_v1,
+    2: read_v2,
+}
+
+
+def load(path):
+    # Memory-map a model file. Returns the fields, the classes, the flat
+    # trees, any extra arrays and the settings. The arrays all read
+    # straight from the mapped file, so processes loading the same file
+    # share its pages
+    with open(path, 'rb') as model_file:
+        buffer = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, length = PREFIX.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("{} is not a model file".format(path))
+    if version not in READERS:
+        raise ValueError("{} has an unknown model format version {}".format(path, version))
+
+    header = json.loads(buffer[PREFIX.size:PREFIX.size + length].decode('utf-8'))
+    start = aligned(PREFIX.size + length)
+
+    return READERS[version](buffer, header, start)
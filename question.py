@@ -1,26 +1,62 @@
+import numpy as np
+
 
 def is_numeric(value):
     # Test if a value is numeric
     return isinstance(value, int) or isinstance(value, float)
 
 
+def is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
 class Question(object):
-    def __init__(self, fields, pos, value):
+    def __init__(self, fields, pos, value, missing=False, legacy=False):
         self.fields = fields
         self.pos = pos
         self.value = value
         self.numeric = is_numeric(value)
+        # Whether entries without a value match a numeric question, as
+        # learned while looking for the split
+        self.missing = missing
+        # Questions of trees from version 1 model files, where zero never
+        # matched a numeric question
+        self.legacy = legacy
 
     def match(self, entry):
         val = entry.data[self.pos]
 
+        if is_missing(val):
+            if self.numeric:
+                return self.missing
+            return self.value is None
+
         if self.numeric:
-            return val and val > self.value
+            return val > self.value and not (self.legacy and val == 0)
         else:
             return val == self.value
 
+    def match_many(self, column):
+        # Match a whole column of values at once, NaN standing for no value
+        column = np.asarray(column)
+
+        if self.value is None:
+            return np.isnan(column)
+
+        if self.numeric:
+            matching = column > self.value
+            if self.missing:
+                matching |= np.isnan(column)
+            if self.legacy:
+                matching &= column != 0
+            return matching
+        else:
+            return column == self.value
+
     def __str__(self):
         condition = self.numeric and ">" or "="
         field = self.fields[self.pos]
+        missing = self.numeric and self.missing and " or missing" or ""
 
-        return "Is {f} {cond} {val}?".format(f=field, cond=condition, val=self.value)
+        return "Is {f} {cond} {val}{missing}?".format(f=field, cond=condition, val=self.value,
+                                                      missing=missing)
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import json
+from collections import deque
+from timeit import default_timer as timer
+import numpy as np
+from forest import Forest
+
+HOST = '127.0.0.1'
+PORT = 8765
+# A batch is predicted as soon as it has MAX_BATCH requests, or MAX_DELAY
+# seconds after its first request arrived
+MAX_BATCH = 256
+MAX_DELAY = 0.002
+# Latencies kept for the stats
+LATENCIES = 10000
+
+
+class Batcher(object):
+    # Gathers the requests that arrive close together into one feature
+    # matrix, so the trees are walked once per batch instead of once per
+    # request
+    def __init__(self, forest, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.forest = forest
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+
+        self.started = timer()
+        self.requests = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCIES)
+
+    async def predict(self, values):
+        # Votes of the forest for one row of values
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((values, future, timer()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch - 1:
+                # Give the requests arriving right after this one some time
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            features = np.array([values for values, future, start in batch], dtype=np.float64)
+            # Off the event loop, so connections keep being served meanwhile
+            votes = await loop.run_in_executor(None, self.forest.vote_batch, features)
+
+            end = timer()
+            self.requests += len(batch)
+            self.batches += 1
+            for (values, future, start), row in zip(batch, votes):
+                self.latencies.append(end - start)
+                if not future.cancelled():
+                    future.set_result(row)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [0, 0, 0]
+        elapsed = timer() - self.started
+
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch': self.requests / float(self.batches) if self.batches else 0,
+            'throughput': self.requests / elapsed,
+            'latency_ms': dict(zip(['p50', 'p95', 'p99'], [float(p) for p in percentiles])),
+        }
+
+
+def parse_values(fields, values):
+    # Row of features out of a request: a list in the order of the fields,
+    # or an object by field name, with null (or no value) for missing values
+    if isinstance(values, dict):
+        values = [values.get(field) for field in fields]
+    if len(values) != len(fields):
+        raise ValueError("Expected {} values, got {}".format(len(fields), len(values)))
+    return [np.nan if value is None else float(value) for value in values]
+
+
+async def answer(batcher, request):
+    forest = batcher.forest
+
+    if not isinstance(request, dict):
+        raise ValueError("Expected a JSON object, got {}".format(type(request).__name__))
+    if request.get('stats'):
+        return batcher.stats()
+
+    values = parse_values(forest.fields, request['values'])
+    votes = await batcher.predict(values)
+    return {
+        'class': forest.classes[int(votes.argmax())],
+        'votes': dict(zip(forest.classes, votes.tolist())),
+    }
+
+
+async def respond(batcher, line):
+    try:
+        response = await answer(batcher, json.loads(line))
+    except (ValueError, KeyError, TypeError) as error:
+        response = {'error': str(error)}
+    return json.dumps(response).encode('utf-8') + b'\n'
+
+
+async def write_responses(responses, writer):
+    # Responses go out in the order of the requests, each as soon as it and
+    # the ones before it are ready
+    while True:
+        response = await responses.get()
+        if response is None:
+            break
+        writer.write(await response)
+        await writer.drain()
+
+
+async def serve_client(batcher, reader, writer):
+    # One JSON request per line, answered with one JSON line each:
+    # {"values": [...]} for a prediction, {"stats": true} for the stats.
+    # Requests don't wait for the answer to the previous one, so a client
+    # sending many at once gets them batched together
+    responses = asyncio.Queue()
+    writing = asyncio.ensure_future(write_responses(responses, writer))
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await responses.put(asyncio.ensure_future(respond(batcher, line)))
+        await responses.put(None)
+        await writing
+    except ConnectionError:
+        writing.cancel()
+    finally:
+        writer.close()
+
+
+async def serve(forest, host=HOST, port=PORT, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+    batcher = Batcher(forest, max_batch, max_delay)
+    batching = asyncio.ensure_future(batcher.run())
+
+    server = await asyncio.start_server(lambda reader, writer:
+                                        serve_client(batcher, reader, writer), host, port)
+    print("Serving {} trees on {}:{}".format(forest.size, host, port))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the predictions of a saved forest")
+    parser.add_argument('model', help="model file written by Forest.save")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-delay', type=float, default=MAX_DELAY)
+    args = parser.parse_args()
+
+    forest = Forest.load(args.model)
+    try:
+        asyncio.run(serve(forest, args.host, args.port, args.max_batch, args.max_delay))
+    except KeyboardInterrupt:
+        pass
@@ -1,26 +1,62 @@
 import csv
+import os
 from timeit import default_timer as timer
+import numpy as np
 from star import Star
+from dataset import Dataset, write_columns
 
+HYG_FILE = 'hygdata_v3.csv'
 STAR_CLASSES = 'OBAFGKMC'
 KEPT_DATA = ['rv', 'absmag', 'ci', 'lum']
+# Columns needed on top of the kept data, to filter and name the stars
+NAME_DATA = ['id', 'proper', 'bf']
+CHUNK_SIZE = 10000
+
+
+def parse_value(value):
+    try:
+        num = float(value)
+        if num == int(num):
+            num = int(num)
+        else:
+            num = round(num, 2)
+        return num
+    except ValueError:
+        if value == '':
+            return None
+        return value
+    except OverflowError:
+        # Infinite values
+        return float(value)
+
+
+def spectral_classes(spect):
+    # Look if the star class letters appear in each possible star type,
+    # ignoring empty star types
+    classes = set()
+    for star_type in spect.split('/'):
+        upper = star_type.upper()
+        classes.update(sp_type for sp_type in STAR_CLASSES if sp_type in upper)
+    return ''.join(sp_type for sp_type in STAR_CLASSES if sp_type in classes)
+
+
+def class_bits(classes):
+    bits = 0
+    for sp_type in classes:
+        bits |= 1 << STAR_CLASSES.index(sp_type)
+    return bits
+
+
+# Spectral classes of every possible bitmask
+BITS_CLASSES = [''.join(sp_type for k, sp_type in enumerate(STAR_CLASSES) if bits & (1 << k))
+                for bits in range(1 << len(STAR_CLASSES))]
 
 
 def make_star(header, row, fields=None):
     data = {}
-    types = []
 
     for field, value in zip(header, row):
-        try:
-            num = float(value)
-            if num == int(num):
-                num = int(num)
-            else:
-                num = round(num, 2)
-            value = num
-        except ValueError:
-            if value == '':
-                value = None
+        value = parse_value(value)
 
         if field == 'dist' and value >= 100000:
             # Discarding star with dubious value
@@ -31,16 +67,7 @@ def make_star(header, row, fields=None):
                 # Discarding unclassified star
                 return None
 
-            type_list = value.split('/')
-
-            # now, for each star_type in typelist
-            # and each sp_type in STAR_CLASSES
-            # add sp_type to the list if
-            # sp_type in star_type.upper()
-
-            # Basically, look if the star class letters appear in each possible star type, and add them, ignoring empty star types
-            types = [sp_type if star_type and sp_type in star_type.upper() else '' for star_type in type_list for sp_type in STAR_CLASSES]
-            value = ''.join(set(types))
+            value = spectral_classes(value)
             if value == '':
                 return None
 
@@ -52,29 +79,166 @@ def make_star(header, row, fields=None):
     return Star(data['spect'], display_name, data, fields)
 
 
-def read_stars(fields=KEPT_DATA):
+def parse_chunks(path=HYG_FILE, fields=KEPT_DATA, chunk_size=CHUNK_SIZE):
+    # Read the CSV a chunk of rows at a time, converting only the needed
+    # columns. Yields (features, labels, names) for each chunk: a float
+    # matrix with NaN for missing values, the spectral classes as a bitmask
+    # of STAR_CLASSES, and the display names
+    with open(path, 'r') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        columns = [header.index(field) for field in fields]
+        spect, dist = header.index('spect'), header.index('dist')
+        star_id, proper, bf = [header.index(field) for field in NAME_DATA]
+
+        features, labels, names = [], [], []
+
+        for row in reader:
+            value = parse_value(row[dist])
+            if value is not None and value >= 100000:
+                # Discarding star with dubious value
+                continue
+
+            if not row[spect]:
+                # Discarding unclassified star
+                continue
+            classes = spectral_classes(row[spect])
+            if classes == '':
+                continue
+
+            values = []
+            for column in columns:
+                value = parse_value(row[column])
+                values.append(np.nan if value is None else value)
+
+            features.append(values)
+            labels.append(class_bits(classes))
+            names.append(row[proper] or row[bf] or ('ID ' + str(parse_value(row[star_id]))))
+
+            if len(features) == chunk_size:
+                yield (np.array(features, dtype=np.float64).reshape(-1, len(fields)),
+                       np.array(labels, dtype=np.uint8), names)
+                features, labels, names = [], [], []
+
+        if features:
+            yield (np.array(features, dtype=np.float64).reshape(-1, len(fields)),
+                   np.array(labels, dtype=np.uint8), names)
+
+
+def cache_path(path):
+    return path + '.cache.npz'
+
+
+def cache_key(path, fields):
+    stat = os.stat(path)
+    return [str(stat.st_mtime_ns), str(stat.st_size)] + list(fields)
+
+
+def read_arrays(path=HYG_FILE, fields=KEPT_DATA, cache=True):
+    # Whole catalog as (features, labels, names) arrays, from the binary
+    # cache next to the CSV as long as the CSV hasn't changed since
+    key = cache_key(path, fields)
+
+    if cache and os.path.exists(cache_path(path)):
+        with np.load(cache_path(path)) as cached:
+            if cached['key'].tolist() == key:
+                return cached['features'], cached['labels'], cached['names']
+
+    features, labels, names = [], [], []
+    for chunk_features, chunk_labels, chunk_names in parse_chunks(path, fields):
+        features.append(chunk_features)
+        labels.append(chunk_labels)
+        names.extend(chunk_names)
+
+    features = np.concatenate(features) if features else np.empty((0, len(fields)))
+    labels = np.concatenate(labels) if labels else np.empty(0, dtype=np.uint8)
+    names = np.array(names, dtype=str)
+
+    if cache:
+        # Write it whole under another name first, so a broken run can't
+        # leave a half-written cache
+        tmp_path = cache_path(path) + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, key=np.array(key), features=features,
+                     labels=labels, names=names)
+        os.replace(tmp_path, cache_path(path))
+
+    return features, labels, names
+
+
+def bits_dataset(fields, features, labels):
+    # Dataset with the classes in a bitmask turned into label columns
+    bits = (labels[:, None] >> np.arange(len(STAR_CLASSES))) & 1
+    present = [k for k in range(len(STAR_CLASSES)) if bits[:, k].any()]
+    present.sort(key=lambda k: STAR_CLASSES[k])
+
+    return Dataset(fields, features, bits[:, present].astype(bool),
+                   [STAR_CLASSES[k] for k in present])
+
+
+def write_catalog(folder, fields=KEPT_DATA, path=HYG_FILE, chunk_size=CHUNK_SIZE):
+    # Write the catalog as a dataset that Dataset.open memory-maps, parsing
+    # it a chunk at a time, so it never has to fit in memory. Every class
+    # gets a label column, whether any star has it or not
+    classes = sorted(STAR_CLASSES)
+    positions = np.array([STAR_CLASSES.index(sp_type) for sp_type in classes])
+
+    chunks = ((features, ((labels[:, None] >> positions) & 1).astype(bool))
+              for features, labels, names in parse_chunks(path, fields, chunk_size))
+    write_columns(folder, fields, classes, chunks)
+
+
+def read_dataset(fields=KEPT_DATA, path=HYG_FILE, cache=True):
+    print("Loading stars...")
+    t_start = timer()
+
+    features, labels, names = read_arrays(path, fields, cache)
+    dataset = bits_dataset(fields, features, labels)
+
+    t_end = timer()
+
+    print("Loaded {} stars.\nElapsed time: {:.3f}\n".format(len(dataset), t_end-t_start))
+
+    return dataset, names
+
+
+def array_star(fields, values, bits, name):
+    # Star out of a row of the parsed arrays, with the values make_star gives
+    data = {}
+    for field, value in zip(fields, values):
+        if value != value:
+            value = None
+        elif value.is_integer():
+            value = int(value)
+        data[field] = value
+
+    return Star(BITS_CLASSES[bits], name, data, fields)
+
+
+def iter_stars(fields=KEPT_DATA, path=HYG_FILE, chunk_size=CHUNK_SIZE):
+    # Stars one at a time, without keeping the whole catalog in memory
+    for features, labels, names in parse_chunks(path, fields, chunk_size):
+        for values, bits, name in zip(features.tolist(), labels.tolist(), names):
+            yield array_star(fields, values, bits, name)
+
+
+def read_stars(fields=KEPT_DATA, path=HYG_FILE, cache=True):
     print("Parsing stars...")
     star_list = []
-    header = None
 
     t_start = timer()
 
-    with open('hygdata_v3.csv', 'r') as csv_file:
-        reader = csv.reader(csv_file)
-        header = next(reader)
-
-        for row in reader:
-            star = make_star(header, row, fields)
-            if star is not None:
-                star_list.append(star)
+    features, labels, names = read_arrays(path, fields, cache)
 
-    csv_file.close()
+    for values, bits, name in zip(features.tolist(), labels.tolist(), names.tolist()):
+        star_list.append(array_star(fields, values, bits, name))
 
     t_end = timer()
 
     print("Parsed {} stars.\nElapsed time: {:.3f}\n".format(len(star_list), t_end-t_start))
 
-    return star_list, fields or header
+    return star_list, fields
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+import csv
+import numpy as np
+from star_reader import STAR_CLASSES, KEPT_DATA, NAME_DATA, bits_dataset
+
+# Columns of the HYG catalog that star_reader needs
+CSV_FIELDS = NAME_DATA + ['dist', 'spect'] + KEPT_DATA
+# Share of stars with a second spectral class (e.g. "KM")
+AMBIGUOUS = 0.1
+# Share of missing values of each kept column
+MISSING = {'rv': 0.3, 'absmag': 0.0, 'ci': 0.05, 'lum': 0.0}
+# Share of zero radial velocities, as in the catalog
+ZERO_RV = 0.3
+
+
+def star_arrays(n, seed=None):
+    # Star-like catalog with n stars: a feature matrix with the KEPT_DATA
+    # columns, related to the spectral classes the way they are in HYG, and
+    # the classes as a bitmask of STAR_CLASSES
+    rng = np.random.default_rng(seed)
+
+    # Only the main sequence classes, hottest first
+    kind = rng.integers(7, size=n)
+    labels = (1 << kind).astype(np.uint8)
+    ambiguous = rng.random(n) < AMBIGUOUS
+    labels[ambiguous] |= (1 << rng.integers(7, size=ambiguous.sum())).astype(np.uint8)
+
+    rv = rng.normal(0, 20, n)
+    rv[rng.random(n) < ZERO_RV] = 0
+    absmag = rng.normal(kind - 2, 1.5)
+    ci = rng.normal(kind * 0.3, 0.2)
+    lum = np.abs(rng.normal(10 - kind, 3))
+
+    features = np.round(np.column_stack([rv, absmag, ci, lum]), 2)
+    for column, field in enumerate(KEPT_DATA):
+        features[rng.random(n) < MISSING[field], column] = np.nan
+
+    return features, labels
+
+
+def synthetic_dataset(n, seed=None):
+    features, labels = star_arrays(n, seed)
+    return bits_dataset(KEPT_DATA, features, labels)
+
+
+def write_csv(path, n, seed=None):
+    # Write a star-like catalog in the HYG CSV format, with just the
+    # columns star_reader needs
+    features, labels = star_arrays(n, seed)
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_FIELDS)
+
+        for k, (values, bits) in enumerate(zip(features.tolist(), labels.tolist())):
+            spect = ''.join(sp_type for i, sp_type in enumerate(STAR_CLASSES) if bits & (1 << i))
+            if len(spect) > 1:
+                spect = '/'.join(spect)
+            row = [k, '', '', round(10 + k % 1000, 2), spect]
+            row += ['' if value != value else value for value in values]
+            writer.writerow(row)
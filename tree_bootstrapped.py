@@ -1,151 +1,341 @@
+import heapq
+import itertools
 import multiprocessing as mp
+from timeit import default_timer as timer
+import numpy as np
+import workers
+import impurity
 from question import Question
+from dataset import Dataset, BINS, MISSING_BIN, FIRST_BIN, CHUNK_ROWS
+from flat_tree import FlatTree
+from metrics import Progress
+import model_file
 
 
-def unique_vals(dataset, indices, column):
-    return set([dataset[i].data[column] for i in indices])
+# Nodes smaller than this are never worth sending to the worker pool
+MIN_PARALLEL = 1000
 
 
-def count_labels(dataset, indices):
-    counts = {}
-    for i in indices:
-        for label in dataset[i].label:
-            if label not in counts:
-                counts[label] = 1
-            else:
-                counts[label] += 1
-    return counts
-
-
-def partition(dataset, indices, question):
-    matching, non_matching = [], []
-
-    for i in indices:
-        if question.match(dataset[i]):
-            matching.append(i)
-        else:
-            non_matching.append(i)
-
-    return matching, non_matching
+def count_labels(dataset, indices, weights=None, multi_label='full'):
+    # Label counts of the entries in indices, each one counted as many times
+    # as its weight if there are weights (one per entry in indices), and
+    # the labels of multi-label entries shared as multi_label says (see
+    # impurity.py)
+    labels = impurity.weighted_labels(dataset.labels[indices], multi_label)
+    if weights is None:
+        return labels.sum(axis=0)
+    return weights.astype(np.int64) @ labels
 
 
-def gini(dataset, indices):
-    counts = count_labels(dataset, indices)
-    impurity = 1
+def label_dict(classes, counts):
+    # Whole counts stay ints, shared labels may leave fractions
+    return {classes[k]: int(counts[k]) if counts[k] % 1 == 0 else float(counts[k])
+            for k in np.flatnonzero(counts)}
 
-    for label in counts:
-        prob = counts[label] / float(len(indices))
-        impurity -= prob**2
 
-    return impurity
+def partition(dataset, indices, question):
+    mask = question.match_many(dataset.features[indices, question.pos])
+
+    return indices[mask], indices[~mask]
+
+
+def child_orders(orders, mask):
+    # Orders of the children of a node, out of the node's own (see
+    # Builder.root_orders) and which of its entries match its question. The
+    # node's orders are filtered, which keeps them sorted, and their
+    # positions renumbered within each child
+    left_positions = np.cumsum(mask) - 1
+    right_positions = np.cumsum(~mask) - 1
+
+    left_orders, right_orders = [], []
+    for order in orders:
+        matching = mask[order]
+        left_orders.append(left_positions[order[matching]])
+        right_orders.append(right_positions[order[~matching]])
+
+    return left_orders, right_orders
+
+
+def gini(dataset, indices, weights=None):
+    counts = count_labels(dataset, indices, weights)
+    return impurity.gini(counts, impurity.label_mass(counts))
+
+
+def best_candidate(uncertainty, counts, total, left_counts, left_totals, min_leaf=1,
+                   criterion=impurity.gini):
+    # Best of several candidate splits of a node with the given label counts
+    # and size, from the label counts and sizes of their matching sides,
+    # all scored by one call to the criterion's kernel. The sizes weigh the
+    # sides, and the kernel scores each one against its label mass. Returns
+    # its gain and position, or (0, None) if none leaves at least min_leaf
+    # entries on each side
+    valid = np.flatnonzero((left_totals >= min_leaf) & (total - left_totals >= min_leaf))
+    if not len(valid):
+        return 0, None
+
+    left_counts, left_totals = left_counts[valid], left_totals[valid]
+    p = left_totals / float(total)
+    right_counts = counts - left_counts
+    gains = (uncertainty
+             - p * criterion(left_counts, impurity.label_mass(left_counts))
+             - (1-p) * criterion(right_counts, impurity.label_mass(right_counts)))
+
+    best = np.argmax(gains)
+    return float(gains[best]), valid[best]
+
+
+def missing_sides(left_counts, left_totals, missing_counts, missing_total):
+    # Candidates with the entries that have no value on the non-matching
+    # side, followed by the same candidates with them on the matching side
+    if not missing_total:
+        return left_counts, left_totals
+
+    return (np.vstack([left_counts, left_counts + missing_counts]),
+            np.r_[left_totals, left_totals + missing_total])
+
+
+def sweep(fields, dataset, indices, column, uncertainty, min_leaf=1, thresholds=None,
+          weights=None, criterion=impurity.gini, multi_label='full', order=None):
+    # Best question of a column: the numeric thresholds are found by sorting
+    # the known values once, from the highest down, and accumulating the
+    # label counts of everything above each distinct value. If the positions
+    # in indices of the known values are given in that order, they aren't
+    # sorted again. If thresholds are given, only those are tried instead.
+    # Each threshold is tried with the entries without a value on either
+    # side. Entries count as many times as their weight, if there are
+    # weights (one per entry in indices). Also returns how many questions
+    # were tried, and the label counts and size of the matching side of the
+    # best question
+    best_gain, best_question, tried, best_left = 0, None, 1, None
+
+    values = dataset.features[indices, column]
+    if weights is None:
+        weights = np.ones(len(indices), dtype=np.int64)
+    else:
+        weights = weights.astype(np.int64)
+    labels = impurity.weighted_labels(dataset.labels[indices], multi_label) * weights[:, None]
+    total = weights.sum()
+    counts = labels.sum(axis=0)
+
+    known = ~np.isnan(values)
+    missing_counts = labels[~known].sum(axis=0)
+    missing_total = total - weights[known].sum()
+
+    if thresholds is not None:
+        # NaN compares False, so the missing values start on the right
+        matching = (values[:, None] > thresholds[None, :]).T.astype(np.int64)
+        left_counts = matching @ labels
+        left_totals = matching @ weights
+        candidates = thresholds
+    else:
+        if order is None:
+            order = np.flatnonzero(known)[np.argsort(-values[known], kind='stable')]
+        ordered = values[order]
+
+        left_counts = np.cumsum(labels[order], axis=0)
+        left_totals = np.cumsum(weights[order])
+
+        # Above each distinct value lies everything sorted before its first entry
+        starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]][:len(ordered)])
+        left_counts = np.vstack([np.zeros_like(counts), left_counts])[starts]
+        left_totals = np.r_[0, left_totals][starts]
+        candidates = ordered[starts]
+
+    if len(candidates):
+        left_counts, left_totals = missing_sides(left_counts, left_totals,
+                                                 missing_counts, missing_total)
+        tried += len(left_totals)
+        gain, best = best_candidate(uncertainty, counts, total, left_counts, left_totals, min_leaf,
+                                    criterion)
+        if gain > best_gain:
+            best_gain = gain
+            best_question = Question(fields, column, candidates[best % len(candidates)].item(),
+                                     best >= len(candidates))
+            best_left = left_counts[best], left_totals[best]
+
+    gain, best = best_candidate(uncertainty, counts, total, missing_counts[None],
+                                np.array([missing_total]), min_leaf, criterion)
+    if gain > best_gain:
+        best_gain, best_question = gain, Question(fields, column, None)
+        best_left = missing_counts, missing_total
+
+    return best_gain, best_question, tried, best_left
+
+
+def histograms(bins, dataset, indices, weights=None, multi_label='full'):
+    # Label counts and sizes of every bin of every column, for the entries
+    # in indices, each one counted as many times as its weight if there are
+    # weights, and their labels shared as multi_label says. The rows are
+    # read a chunk at a time, so a node's histograms can be gathered from a
+    # dataset that doesn't fit in memory
+    size = len(dataset.classes)
+    columns = bins.codes.shape[1]
+    dtype = np.int64 if weights is None and multi_label == 'full' else np.float64
+
+    counts = np.zeros((columns, BINS, size), dtype=dtype)
+    totals = np.zeros((columns, BINS), dtype=dtype)
+
+    for start in range(0, len(indices), CHUNK_ROWS):
+        chunk = indices[start:start + CHUNK_ROWS]
+        codes = bins.codes[chunk].astype(np.intp)
+        labels = dataset.labels[chunk]
+        entries, classes = np.nonzero(labels)
+        chunk_weights = None if weights is None else weights[chunk].astype(np.float64)
+        entry_weights = None if weights is None else chunk_weights[entries]
+        shares = impurity.label_shares(labels, multi_label)
+        if shares is not None:
+            entry_weights = shares[entries] * (1 if entry_weights is None else entry_weights)
+
+        for column in range(columns):
+            counts[column] += (np.bincount(codes[entries, column] * size + classes,
+                                           entry_weights, minlength=BINS * size)
+                               .reshape(BINS, size))
+            totals[column] += np.bincount(codes[:, column], chunk_weights, minlength=BINS)
+
+    return counts, totals
+
+
+def hist_sweep(fields, bins, counts, totals, column, uncertainty, min_leaf=1, positions=None,
+               criterion=impurity.gini):
+    # Best question of a column, from the histograms of its bins. The
+    # question for each bin edge matches every value bin above it, and maybe
+    # the missing values bin. If edge positions are given, only those edges
+    # are tried. Also returns how many questions were tried, and the label
+    # counts and size of the matching side of the best question
+    best_gain, best_question, best_left = 0, None, None
+
+    edges = bins.edges[column]
+    total = totals[column].sum()
+    node_counts = counts[column].sum(axis=0)
+
+    values = slice(FIRST_BIN, FIRST_BIN + len(edges))
+    above_counts = np.cumsum(counts[column, values][::-1], axis=0)[::-1]
+    above_totals = np.cumsum(totals[column, values][::-1])[::-1]
+
+    # Matching side of the question for edge k: the value bins past k
+    left_counts = np.vstack([above_counts[1:], np.zeros_like(node_counts)[None]])
+    left_totals = np.r_[above_totals[1:], 0]
+
+    if positions is None:
+        # From the highest edge down, like the values in sweep
+        positions = np.arange(len(edges))[::-1]
+
+    left_counts, left_totals = missing_sides(left_counts[positions], left_totals[positions],
+                                             counts[column, MISSING_BIN],
+                                             totals[column, MISSING_BIN])
+    tried = len(left_totals) + 1
+    gain, best = best_candidate(uncertainty, node_counts, total, left_counts, left_totals,
+                                min_leaf, criterion)
+    if gain > best_gain:
+        best_gain = gain
+        best_question = Question(fields, column, edges[positions[best % len(positions)]].item(),
+                                 best >= len(positions))
+        best_left = left_counts[best], left_totals[best]
+
+    gain, best = best_candidate(uncertainty, node_counts, total,
+                                counts[column, MISSING_BIN][None],
+                                totals[column, MISSING_BIN][None], min_leaf, criterion)
+    if gain > best_gain:
+        best_gain, best_question = gain, Question(fields, column, None)
+        best_left = counts[column, MISSING_BIN], totals[column, MISSING_BIN]
+
+    return best_gain, best_question, tried, best_left
 
 
-def info_gain(dataset, lid, rid, uncertainty):
-    p = float(len(lid)) / float(len(lid) + len(rid))
+def splitter(info):
+    # Pool task: sweep a column of the dataset the workers are attached to.
+    # Also returns how long the sweep took in the worker
+    (indices, column, uncertainty, min_leaf, thresholds, weights, criterion, multi_label,
+     order) = info
+    dataset = workers.shared_dataset()
+    t_start = timer()
+    split = sweep(dataset.fields, dataset, indices, column, uncertainty, min_leaf, thresholds,
+                  weights, criterion, multi_label, order)
+    return split, timer() - t_start
+
+
+def best_time(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        t_start = timer()
+        func()
+        times.append(timer() - t_start)
+    return min(times)
+
+
+def measure_crossover(pool, dataset):
+    # Smallest node size at which sweeping the columns on the pool is faster
+    # than sweeping them in this process, growing the size 4x at a time
+    rng = np.random.default_rng(0)
+    columns = range(len(dataset.fields))
+    size = MIN_PARALLEL
+
+    while size <= len(dataset):
+        indices = rng.integers(len(dataset), size=size).astype(np.intp)
+        uncertainty = gini(dataset, indices)
+        tasks = [(indices, column, uncertainty, 1, None, None, impurity.gini, 'full', None)
+                 for column in columns]
+
+        local = best_time(lambda: [sweep(dataset.fields, dataset, indices, column, uncertainty)
+                                   for column in columns])
+        pooled = best_time(lambda: pool.map(splitter, tasks))
+
+        if pooled < local:
+            return size
+        size *= 4
+
+    return float('inf')
+
+
+def split_pool(dataset, metrics=None, processes=None):
+    # Worker pool for a whole training run, or None if it can't pay off
+    processes = min(processes or mp.cpu_count(), len(dataset.fields))
+    if processes < 2 or len(dataset) < MIN_PARALLEL:
+        return None
 
-    return uncertainty - p * gini(dataset, lid) - (1-p) * gini(dataset, rid)
+    pool = workers.Pool(dataset, processes)
+    pool.crossover = measure_crossover(pool, dataset)
 
+    if metrics is not None:
+        metrics.pool(processes, pool.crossover)
 
-def splitter(info):
-    question, dataset, indices, uncertainty = info
-    matching, non_matching = partition(dataset, indices, question)
-    if not matching or not non_matching:
-        return None
-    gain = info_gain(dataset, matching, non_matching, uncertainty)
-    return (gain, question, (matching, non_matching))
+    return pool
 
 
 class Node(object):
-    def __init__(self, fields, dataset, bootstrap, level=0, out=True):
-        self.fields = fields
-        self.dataset = dataset
-        self.indices = bootstrap
-        self.out = out
-        self.gini = gini(dataset, self.indices)
-        self.build(level, out)
-
-    def build(self, level, out=True):
-        best_split = self.split(out)
-        gain, question, branches = best_split
-
-        if not branches:
-            # Means we got 0 gain
-            if out:
-                print("Found a leaf at level {}".format(level))
-            self.predictions = count_labels(self.dataset, self.indices)
-            self.is_leaf = True
-            return
-
-        left, right = branches
-
-        if out:
-            print("Found a level {} split:".format(level))
-            print(question)
-            print("Matching: {} entries\tNon-matching: {} entries".format(len(left), len(right)))
-
-        self.left_branch = Node(self.fields, self.dataset, left, level + 1, out)
-        self.right_branch = Node(self.fields, self.dataset, right, level + 1, out)
+    # Nodes keep nothing from the training data but their impurity and, for
+    # the leaves, their label counts. The entries of each node only live in
+    # the Builder while it's being split
+    __slots__ = ('level', 'gini', 'is_leaf', 'predictions', 'question',
+                 'left_branch', 'right_branch')
+
+    def __init__(self, gini, level=0):
+        self.level = level
+        self.gini = gini
+        self.is_leaf = True
+        self.predictions = None
+        self.question = None
+        self.left_branch = None
+        self.right_branch = None
+
+    def make_leaf(self, predictions):
+        self.predictions = predictions
+        self.is_leaf = True
+
+    def make_split(self, question, left_branch, right_branch):
         self.question = question
+        self.left_branch = left_branch
+        self.right_branch = right_branch
         self.is_leaf = False
-        return
-
-    def split(self, out=True):
-        if out:
-            print("Splitting {} entries.".format(len(self.indices)))
-        best_gain, best_question, best_split = 0, None, None
-
-        uncertainty = self.gini or gini(self.dataset, self.indices)
-
-        cpus = mp.cpu_count()
-        columns = len(self.fields)
-
-        parallelize = len(self.indices) > 1000
-
-        if parallelize and out:
-            print("\n-- Using {} CPUs to parallelize the split search\n".format(cpus))
-
-        for i in range(columns):
-            values = unique_vals(self.dataset, self.indices, i)
-
-            if parallelize:
-                # Parallelize best split search
-                splits = []
-                for value in values:
-                    question = Question(self.fields, i, value)
-                    splits.append((question, self.dataset, self.indices, uncertainty))
-
-                chunk = max(int(len(splits)/(cpus*4)), 1)
-                with mp.Pool(cpus) as p:
-                    for split in p.imap_unordered(splitter, splits, chunksize=chunk):
-                        if split is not None:
-                            gain, question, branches = split
-                            if gain > best_gain:
-                                best_gain, best_question, best_split = gain, question, branches
-            else:
-                for value in values:
-                    question = Question(self.fields, i, value)
-
-                    matching, non_matching = partition(self.dataset, self.indices, question)
-
-                    if not matching or not non_matching:
-                        continue
-
-                    gain = info_gain(self.dataset, matching, non_matching, uncertainty)
-
-                    if gain > best_gain:
-                        best_gain, best_question = gain, question
-                        best_split = (matching, non_matching)
-
-        return best_gain, best_question, best_split
 
     def classify(self, entry):
-        if self.is_leaf:
-            return self
-
-        if self.question.match(entry):
-            return self.left_branch.classify(entry)
-        else:
-            return self.right_branch.classify(entry)
+        node = self
+        while not node.is_leaf:
+            if node.question.match(entry):
+                node = node.left_branch
+            else:
+                node = node.right_branch
+        return node
 
     def predict(self, entry):
         successes = []
@@ -162,43 +352,484 @@ class Node(object):
         return sum(successes), predict
 
     def print(self, spacing=''):
-        if self.is_leaf:
-            s = spacing + "Predict: "
-            total = float(sum(self.predictions.values()))
-            probs = {}
-            for label in self.predictions:
-                prob = self.predictions[label] * 100 / total
-                probs[label] = "{:.2f}%".format(prob)
-            return s + str(probs)
-
-        s = spacing + ("(Gini: {:.2f}) {}\n"
-                       .format(self.gini, str(self.question)))
-        s += spacing + "├─ True:\n"
-        s += self.left_branch.print(spacing + "│  ") + '\n'
-        s += spacing + "└─ False:\n"
-        s += self.right_branch.print(spacing + "   ")
-
-        return s
+        # Drawn from an explicit stack, as the tree was grown, so deep trees
+        # can't hit Python's recursion limit either. The stack holds nodes
+        # still to draw, with their spacing, and text to add in between
+        parts = []
+        pending = [(self, spacing)]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+
+            node, spacing = item
+            if node.is_leaf:
+                total = float(sum(node.predictions.values()))
+                probs = {}
+                for label in node.predictions:
+                    prob = node.predictions[label] * 100 / total
+                    probs[label] = "{:.2f}%".format(prob)
+                parts.append(spacing + "Predict: " + str(probs))
+                continue
+
+            parts.append(spacing + ("(Impurity: {:.2f}) {}\n"
+                                    .format(node.gini, str(node.question))))
+            parts.append(spacing + "├─ True:\n")
+            pending += [(node.right_branch, spacing + "   "), spacing + "└─ False:\n", '\n',
+                        (node.left_branch, spacing + "│  ")]
+
+        return ''.join(parts)
 
     def __str__(self):
         return self.print()
 
 
+def feature_count(max_features, columns):
+    # Number of columns to search at each node
+    if max_features is None:
+        return columns
+    if max_features == 'sqrt':
+        count = int(np.sqrt(columns))
+    elif max_features == 'log2':
+        count = int(np.log2(columns))
+    elif isinstance(max_features, float):
+        count = int(max_features * columns)
+    elif isinstance(max_features, int):
+        count = max_features
+    else:
+        raise ValueError("Unknown max_features {!r}".format(max_features))
+    return min(max(count, 1), columns)
+
+
+def unflatten(flat, fields, classes):
+    # Nodes back out of a flat tree, without any training state
+    nodes = []
+    for k in range(len(flat)):
+        node = Node(float(flat.impurity[k]))
+        node.make_leaf(label_dict(classes, flat.value[k]))
+        nodes.append(node)
+
+    # Parents always come before their children
+    for k, node in enumerate(nodes):
+        if flat.feature[k] < 0:
+            continue
+        threshold = float(flat.threshold[k])
+        value = None if np.isnan(threshold) else threshold
+        left, right = nodes[flat.left[k]], nodes[flat.right[k]]
+        left.level = right.level = node.level + 1
+        node.predictions = None
+        question = Question(fields, int(flat.feature[k]), value, bool(flat.missing[k]),
+                            flat.legacy)
+        node.make_split(question, left, right)
+
+    return nodes[0]
+
+
+class Builder(object):
+    # Grows a tree without recursion. Nodes waiting to be split are kept in
+    # a stack, so the tree grows depth-first, or in a queue ordered by the
+    # gain of their best split when the number of leaves is limited
+    def __init__(self, fields, dataset, metrics=None, pool=None, bins=None, max_depth=None,
+                 min_samples_split=2, min_samples_leaf=1, min_impurity_decrease=0.0,
+                 max_leaf_nodes=None, max_features=None, random_thresholds=None, rng=None,
+                 criterion='gini', multi_label='full'):
+        self.fields = fields
+        self.dataset = dataset
+        # Progress or Metrics to report to, if any
+        self.metrics = metrics
+        self.pool = pool
+        self.bins = bins
+        self.max_depth = max_depth
+        self.min_samples_split = max(min_samples_split, 2)
+        self.min_samples_leaf = max(min_samples_leaf, 1)
+        self.min_impurity_decrease = min_impurity_decrease
+        self.max_leaf_nodes = max_leaf_nodes
+        self.max_features = feature_count(max_features, len(fields))
+        # Random thresholds tried per column, or None to try them all
+        self.random_thresholds = random_thresholds
+        self.rng = np.random.default_rng(rng)
+        # Impurity kernel, and how the labels of multi-label entries count
+        # (see impurity.py)
+        self.criterion = impurity.criterion(criterion)
+        self.multi_label = multi_label
+        # Times each entry was drawn, when the nodes keep every entry once
+        self.weights = None
+        # Impurity decrease of the splits on each column, weighted by the
+        # share of the entries in the node being split
+        self.importances = np.zeros(len(fields))
+
+    def thresholds(self, indices, column, hist=None):
+        # Random thresholds of a column, uniformly drawn between the lowest
+        # and highest values of the node (or edges of its bins)
+        k = self.random_thresholds
+        if k is None:
+            return None
+
+        if self.bins is not None:
+            edges = len(self.bins.edges[column])
+            used = np.flatnonzero(hist[1][column, FIRST_BIN:FIRST_BIN + edges])
+            if len(used) < 2:
+                return np.empty(0, dtype=np.intp)
+            return self.rng.integers(used[0], used[-1], size=k)
+
+        values = self.dataset.features[indices, column]
+        known = ~np.isnan(values)
+        # Entries with a value, counting each as many times as its weight
+        if self.weights is None:
+            size = np.count_nonzero(known)
+        else:
+            size = self.weights[indices][known].sum()
+        if size < 2:
+            return np.empty(0)
+        values = values[known]
+        return self.rng.uniform(values.min(), values.max(), size=k)
+
+    def search(self, node, indices, columns, hist=None, orders=None):
+        # Best question among some columns, its gain, how many questions
+        # were tried, and the label counts and size of its matching side
+        best_gain, best_question, tried, best_left = 0, None, 0, None
+
+        uncertainty = node.gini
+        min_leaf = self.min_samples_leaf
+        pool = self.pool
+        thresholds = [self.thresholds(indices, i, hist) for i in columns]
+        weights = None if self.weights is None else self.weights[indices]
+
+        parallelize = pool is not None and len(indices) >= pool.crossover
+
+        if self.bins is not None:
+            counts, totals = hist
+            splits = [hist_sweep(self.fields, self.bins, counts, totals, i, uncertainty, min_leaf,
+                                 positions, self.criterion)
+                      for i, positions in zip(columns, thresholds)]
+        elif parallelize:
+            # Parallelize best split search, one column per task
+            tasks = [(indices, i, uncertainty, min_leaf, column_thresholds, weights,
+                      self.criterion, self.multi_label, None if orders is None else orders[i])
+                     for i, column_thresholds in zip(columns, thresholds)]
+            if self.metrics is not None:
+                t_start = timer()
+            splits, times = zip(*pool.map(splitter, tasks))
+            if self.metrics is not None:
+                self.metrics.dispatch(pool.processes, len(tasks), t_start, timer() - t_start,
+                                      sum(times))
+        else:
+            splits = [sweep(self.fields, self.dataset, indices, i, uncertainty, min_leaf,
+                            column_thresholds, weights, self.criterion, self.multi_label,
+                            None if orders is None else orders[i])
+                      for i, column_thresholds in zip(columns, thresholds)]
+
+        for gain, question, column_tried, left in splits:
+            tried += column_tried
+            if gain > best_gain:
+                best_gain, best_question, best_left = gain, question, left
+
+        return best_gain, best_question, tried, best_left
+
+    def split(self, node, indices, hist=None, orders=None):
+        # Best question for a node, its gain, and the label counts and size
+        # of its matching side
+        if self.metrics is not None:
+            t_start = timer()
+
+        columns = len(self.fields)
+        if self.max_features >= columns:
+            best_gain, best_question, tried, left = self.search(node, indices, range(columns),
+                                                                hist, orders)
+        else:
+            # Only a random subset of the columns, unless none of them can
+            # split the node
+            order = self.rng.permutation(columns)
+            best_gain, best_question, tried, left = self.search(node, indices,
+                                                                order[:self.max_features], hist,
+                                                                orders)
+            if best_question is None:
+                best_gain, best_question, more, left = self.search(node, indices,
+                                                                   order[self.max_features:],
+                                                                   hist, orders)
+                tried += more
+
+        if self.metrics is not None:
+            self.metrics.split(node.level, len(indices), best_gain, tried, t_start,
+                               timer() - t_start)
+
+        return best_gain, best_question, left
+
+    def root_orders(self, indices):
+        # Positions in indices of the entries with a value for each column,
+        # sorted from the highest value down. Every node's orders are
+        # filtered out of its parent's, so this is the only sorting a tree
+        # does. When the indices are the entries with a weight, in order,
+        # they're taken from the dataset's presorted columns, which are
+        # sorted once for every tree
+        if self.weights is None:
+            orders = []
+            for column in range(len(self.fields)):
+                values = self.dataset.features[indices, column]
+                known = np.flatnonzero(~np.isnan(values))
+                orders.append(known[np.argsort(-values[known], kind='stable')])
+            return orders
+
+        order, known = self.dataset.presorted()
+        positions = np.full(len(self.dataset), -1, dtype=np.intp)
+        positions[indices] = np.arange(len(indices))
+
+        orders = []
+        for column in range(len(self.fields)):
+            column_positions = positions[order[:known[column], column]]
+            orders.append(column_positions[column_positions >= 0])
+        return orders
+
+    def label_counts(self, indices, hist=None):
+        # Label counts and size of a node, weighted if the entries are
+        if hist is not None:
+            # Any column's histograms add up to the whole node
+            return hist[0][0].sum(axis=0), hist[1][0].sum()
+        if self.weights is not None:
+            weights = self.weights[indices]
+            return (count_labels(self.dataset, indices, weights, self.multi_label),
+                    int(weights.sum()))
+        return count_labels(self.dataset, indices, multi_label=self.multi_label), len(indices)
+
+    def node(self, labels, level):
+        # Node with the given label counts and size
+        counts, size = labels
+        return Node(self.criterion(counts, impurity.label_mass(counts)), level)
+
+    def make_leaf(self, node, labels):
+        counts, size = labels
+        if self.metrics is not None:
+            self.metrics.leaf(node.level, size)
+        node.make_leaf(label_dict(self.dataset.classes, counts))
+
+    def add(self, pending, node, indices, hist, orders, labels, total):
+        # Either turn the node into a leaf right away, or queue it with its
+        # entries, label counts and best split. The counts are only ever
+        # computed for the root: every other node gets them from the split
+        # search of its parent
+        size = labels[1]
+        if ((self.max_depth is None or node.level < self.max_depth)
+                and size >= self.min_samples_split):
+            gain, question, left = self.split(node, indices, hist, orders)
+
+            # Impurity decrease weighted by the share of entries in the node
+            decrease = gain * size / float(total)
+
+            if question is not None and decrease >= self.min_impurity_decrease:
+                if self.max_leaf_nodes is None:
+                    pending.append((node, indices, question, hist, orders, labels, left))
+                else:
+                    heapq.heappush(pending, (-decrease, next(self.order),
+                                             node, indices, question, hist, orders, labels, left))
+                return
+
+        # Means we got 0 gain, or the node may not be split
+        self.make_leaf(node, labels)
+
+    def build(self, bootstrap=None):
+        # Tree of the entries in bootstrap or, if the builder has weights,
+        # of every entry with a weight, counted as many times as its weight
+        if self.weights is not None:
+            indices = np.flatnonzero(self.weights)
+            total = int(self.weights.sum())
+        else:
+            indices = np.asarray(bootstrap, dtype=np.intp)
+            total = len(indices)
+        self.order = itertools.count()
+
+        pending = []
+        hist, orders = None, None
+        if self.bins is not None:
+            hist = histograms(self.bins, self.dataset, indices, self.weights, self.multi_label)
+        elif self.random_thresholds is None:
+            orders = self.root_orders(indices)
+        labels = self.label_counts(indices, hist)
+        root = self.node(labels, 0)
+        self.add(pending, root, indices, hist, orders, labels, total)
+
+        leaves = 1
+        while pending:
+            if self.max_leaf_nodes is None:
+                node, indices, question, hist, orders, labels, left_labels = pending.pop()
+            elif leaves < self.max_leaf_nodes:
+                (node, indices, question, hist, orders, labels,
+                 left_labels) = heapq.heappop(pending)[2:]
+            else:
+                # Out of leaves, whatever is still queued stays a leaf
+                for entry in pending:
+                    self.make_leaf(entry[2], entry[7])
+                break
+
+            level = node.level
+            if self.metrics is not None:
+                t_start = timer()
+            mask = question.match_many(self.dataset.features[indices, question.pos])
+            left, right = indices[mask], indices[~mask]
+            left_orders, right_orders = None, None
+            if orders is not None:
+                left_orders, right_orders = child_orders(orders, mask)
+            # The node's own entries aren't needed anymore
+            indices, orders, mask = None, None, None
+
+            if self.metrics is not None:
+                self.metrics.partition(level, question, len(left), len(right), t_start,
+                                       timer() - t_start)
+
+            left_hist, right_hist = None, None
+            if self.bins is not None:
+                # Only the smaller side gets its histograms built, the other
+                # side's are what is left of this node's
+                if len(left) <= len(right):
+                    left_hist = histograms(self.bins, self.dataset, left, self.weights,
+                                           self.multi_label)
+                    right_hist = hist[0] - left_hist[0], hist[1] - left_hist[1]
+                else:
+                    right_hist = histograms(self.bins, self.dataset, right, self.weights,
+                                            self.multi_label)
+                    left_hist = hist[0] - right_hist[0], hist[1] - right_hist[1]
+            hist = None
+
+            # The non-matching side has whatever the matching side doesn't
+            right_labels = labels[0] - left_labels[0], labels[1] - left_labels[1]
+            left_branch = self.node(left_labels, level + 1)
+            right_branch = self.node(right_labels, level + 1)
+            node.make_split(question, left_branch, right_branch)
+            leaves += 1
+            self.importances[question.pos] += (labels[1] * node.gini
+                                               - left_labels[1] * left_branch.gini
+                                               - right_labels[1] * right_branch.gini) / total
+
+            # The matching side goes on top, to be split first
+            self.add(pending, right_branch, right, right_hist, right_orders, right_labels, total)
+            self.add(pending, left_branch, left, left_hist, left_orders, left_labels, total)
+            left, right, left_hist, right_hist = None, None, None, None
+            left_orders, right_orders = None, None
+
+        return root
+
+
 class Tree(object):
-    def __init__(self, fields, dataset, bootstrap, out=True):
+    def __init__(self, fields, dataset, bootstrap=None, out=True, pool=None, n_jobs=None,
+                 bins=None, max_depth=None, min_samples_split=2, min_samples_leaf=1,
+                 min_impurity_decrease=0.0, max_leaf_nodes=None, max_features=None,
+                 random_thresholds=None, seed=None, metrics=None, weights=None, criterion='gini',
+                 multi_label='full'):
+        # The tree is trained with the entries in bootstrap (a list of
+        # positions, repeated for entries drawn more than once) or, instead,
+        # with the times each entry was drawn in weights. With neither, every
+        # entry is used once. metrics gets told about every step of the
+        # training (see metrics.py). Without it, out just prints the progress
+        if bootstrap is not None and weights is not None:
+            raise ValueError("A tree takes either a bootstrap or weights, not both")
+        if not isinstance(dataset, Dataset):
+            dataset = Dataset.from_entries(dataset, fields)
+        if metrics is None and out:
+            metrics = Progress()
+        if metrics is not None:
+            t_start = timer()
+
         self.fields = fields
         self.dataset = dataset
-        self.indices = bootstrap
+        self.classes = dataset.classes
+        # Times each entry was drawn into the bootstrap
+        if bootstrap is not None:
+            weights = np.bincount(bootstrap, minlength=len(dataset))
+        elif weights is None:
+            weights = np.ones(len(dataset), dtype=np.uint16)
+        self.counts = np.asarray(weights).astype(np.uint16)
         # Out of bag
-        self.oob = [i for i in range(len(dataset)) if i not in bootstrap]
-
-        self.root = Node(self.fields, self.dataset, self.indices, out=out)
+        self.oob = np.flatnonzero(self.counts == 0)
+
+        builder = Builder(self.fields, self.dataset, metrics, max_depth=max_depth,
+                          min_samples_split=min_samples_split,
+                          min_samples_leaf=min_samples_leaf,
+                          min_impurity_decrease=min_impurity_decrease,
+                          max_leaf_nodes=max_leaf_nodes, max_features=max_features,
+                          random_thresholds=random_thresholds, rng=seed, criterion=criterion,
+                          multi_label=multi_label)
+        # Each drawn entry is kept once, weighted by how many times it was
+        # drawn, instead of a list with all of its copies
+        builder.weights = self.counts
+
+        if bins is not None:
+            # Binned split search, which needs no pool
+            builder.bins = self.dataset.binned(bins)
+            self.root = builder.build()
+        elif pool is not None:
+            builder.pool = pool
+            self.root = builder.build()
+        else:
+            # Own pool, just for this tree
+            builder.pool = split_pool(self.dataset, metrics, n_jobs)
+            try:
+                self.root = builder.build()
+            finally:
+                if builder.pool is not None:
+                    builder.pool.close()
+
+        self.flat = FlatTree.from_node(self.root, self.classes)
+        # The nodes take several times the memory of the flat tree, and
+        # get_root rebuilds them from it if they're asked for
+        self.root = None
+        # Gathered for free while splitting, see Forest.feature_importances
+        self.importances = builder.importances
+
+        if metrics is not None:
+            metrics.tree(len(self.flat), int(np.count_nonzero(self.flat.feature < 0)), t_start,
+                         timer() - t_start)
+
+    @classmethod
+    def from_flat(cls, fields, classes, flat):
+        # Trained tree without any training state, as loaded from a file
+        tree = cls.__new__(cls)
+        tree.fields = fields
+        tree.dataset = None
+        tree.classes = classes
+        tree.counts = None
+        tree.oob = None
+        tree.root = None
+        tree.flat = flat
+        tree.importances = None
+        return tree
+
+    def get_root(self):
+        # Trees only get their nodes back if someone asks for them
+        if self.root is None:
+            self.root = unflatten(self.flat, self.fields, self.classes)
+        return self.root
 
     def classify(self, entry):
-        return self.root.classify(entry)
+        return self.get_root().classify(entry)
 
     def predict(self, entry):
-        return self.root.predict(entry)
+        return self.get_root().predict(entry)
+
+    def save(self, path):
+        extra = None
+        if self.importances is not None:
+            extra = {'importances': self.importances[None]}
+        model_file.save(path, self.fields, self.classes, [self.flat], extra)
+
+    @classmethod
+    def load(cls, path):
+        fields, classes, flats, extra, settings = model_file.load(path)
+        tree = cls.from_flat(fields, classes, flats[0])
+        if 'importances' in extra:
+            tree.importances = extra['importances'][0]
+        return tree
+
+    def predict_batch(self, features):
+        # Class probabilities for each row of a feature matrix, one column
+        # per class in self.classes
+        counts = self.flat.predict(features)
+        return counts / counts.sum(axis=1)[:, None]
+
+    def __getstate__(self):
+        # The dataset stays behind when a tree is sent between processes
+        state = self.__dict__.copy()
+        state['dataset'] = None
+        return state
 
     def __str__(self):
-        return str(self.root)
+        return str(self.get_root())
@@ -1,7 +1,8 @@
 import os
 from timeit import default_timer as timer
-from star_reader import read_stars
+from star_reader import read_dataset
 from tree_bootstrapped import Tree
+from evaluation import evaluate
 
 
 OUTPUT_FOLDER = "output/tree"
@@ -22,7 +23,8 @@ if __name__ == '__main__':
     else:
         output = open(OUTPUT_FOLDER + "/testing.txt", 'a', encoding="utf-8")
 
-    dataset, fields = read_stars()
+    dataset, names = read_dataset()
+    fields = dataset.fields
 
     log("\n----------\n", output)
 
@@ -32,12 +34,13 @@ if __name__ == '__main__':
     cut = 0.02
 
     split = int(len(dataset) * cut)
-    training, testing = dataset[:split], dataset[split + 1:]
+    training_set = dataset.subset(slice(split))
+    testing_set = dataset.subset(slice(split + 1, None))
     log("Dataset split: Training with {}% of the set".format(cut*100), output)
-    log("Training set: {} entries.".format(len(training)), output)
-    log("Testing set: {} entries.".format(len(testing)), output)
+    log("Training set: {} entries.".format(len(training_set)), output)
+    log("Testing set: {} entries.".format(len(testing_set)), output)
 
-    tree = Tree(fields, training, [i for i in range(len(training))])
+    tree = Tree(fields, training_set, [i for i in range(len(training_set))])
 
     t_end = timer()
     log("Training complete.\nElapsed time: {:.3f}\n".format(t_end - t_start), output)
@@ -46,18 +49,9 @@ if __name__ == '__main__':
 
     log("\n-- TEST --\n", output)
 
-    total_success = 0
-
-    for entry in testing:
-        success, predict = tree.predict(entry)
-        print("Actual: {}\tPredicted: {}.\tSuccess: {}".format(entry.label, predict, success))
-        total_success += success
-
-    tested = len(testing)
-    s_rate = float(total_success)*100/float(tested)
-
-    log("\nTested {} entries.".format(tested), output)
-
-    log("Accuracy: {:.2f}%\nError: {:.2f}%".format(s_rate, 100-s_rate), output)
+    t_start = timer()
+    evaluation = evaluate(tree, testing_set)
+    log(evaluation.summary(), output)
+    log("Elapsed time: {:.3f}".format(timer() - t_start), output)
 
     output.close()
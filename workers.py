@@ -0,0 +1,134 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from dataset import Dataset, Bins
+
+
+# Dataset the worker processes attach to, set up by the pool initializer,
+# and the trees they were given, if any
+_dataset = None
+_blocks = []
+_trees = None
+
+
+class SharedDataset(object):
+    # Copy of a dataset's matrices in shared memory, which the worker
+    # processes attach to by name instead of receiving it pickled. So are
+    # its presorted columns and the codes of its bins, if they were made,
+    # and the bin edges go along with the descriptor
+    def __init__(self, dataset):
+        self.fields = dataset.fields
+        self.classes = dataset.classes
+        self.blocks = []
+        self.layout = []
+        self.edges = {}
+
+        arrays = [('features', dataset.features), ('labels', dataset.labels)]
+        if dataset.order is not None:
+            arrays += [('order', dataset.order), ('known', dataset.known)]
+        for size, bins in dataset.bins.items():
+            arrays.append(('codes{}'.format(size), bins.codes))
+            self.edges[size] = bins.edges
+        for name, array in arrays:
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            # Presorted columns stay column after column
+            layout = 'F' if array.ndim > 1 and array.flags.f_contiguous else 'C'
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, order=layout)
+            shared[...] = array
+            self.blocks.append(block)
+            self.layout.append((name, block.name, array.shape, array.dtype.str, layout))
+
+    def descriptor(self):
+        return self.fields, self.classes, self.layout, self.edges
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+class MappedDataset(object):
+    # A dataset memory-mapped from a folder needs no copy, the workers just
+    # open the same files, and share the pages the system already read
+    def __init__(self, dataset):
+        self.folder = dataset.folder
+
+    def descriptor(self):
+        return self.folder
+
+    def close(self):
+        pass
+
+
+def attach(descriptor):
+    if isinstance(descriptor, str):
+        return Dataset.open(descriptor), []
+
+    fields, classes, layout, edges = descriptor
+    blocks, arrays = [], {}
+
+    for name, block_name, shape, dtype, order in layout:
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, order=order)
+
+    dataset = Dataset(fields, arrays['features'], arrays['labels'], classes)
+    dataset.order = arrays.get('order')
+    dataset.known = arrays.get('known')
+    for size, column_edges in edges.items():
+        dataset.bins[size] = Bins(arrays['codes{}'.format(size)], column_edges)
+    return dataset, blocks
+
+
+def _init_worker(descriptor, trees=None):
+    global _dataset, _blocks, _trees
+    _dataset, _blocks = attach(descriptor)
+    _trees = trees
+
+
+def shared_dataset():
+    # Dataset of the current worker process
+    return _dataset
+
+
+def shared_trees():
+    # Trees of the current worker process
+    return _trees
+
+
+class Pool(object):
+    # Worker processes that live for a whole training run, all attached to
+    # the same shared copy of the dataset. trees, if given, are sent to
+    # every worker once, for the tasks that use them: flat trees, or
+    # whatever else the tasks need of them
+    def __init__(self, dataset, processes=None, trees=None):
+        self.processes = processes or mp.cpu_count()
+        if dataset.folder is not None:
+            self.shared = MappedDataset(dataset)
+        else:
+            self.shared = SharedDataset(dataset)
+        self.pool = mp.Pool(self.processes, initializer=_init_worker,
+                            initargs=(self.shared.descriptor(), trees))
+        # Smallest amount of entries worth sending to the workers
+        self.crossover = None
+
+    def map(self, func, tasks):
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def imap(self, func, tasks):
+        # Results in the order of the tasks, as soon as each one is ready
+        return self.pool.imap(func, tasks, chunksize=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()